@@ -0,0 +1,735 @@
+"""
+    Офлайн-бенчмарк VoiceMod.
+
+    Загружает voicemod.py с подставными loader/utils, клиентом Telegram,
+    PyTgCalls и shazamio, гоняет сотни параллельных команд по множеству
+    чатов и выводит задержки команд и подвисания event loop.
+
+    Если установлен yt-dlp, ссылки отдаются ему с локального HTTP-сервера,
+    иначе используется подставной yt_dlp с настраиваемой задержкой.
+
+    Команда считается проваленной, если упала или ответила текстом ошибки
+    (сами команды ошибки перехватывают и только отвечают о них).
+
+    Режимы: --lazy-init, --mixer (нужен ffmpeg), --shards N (подставные воркеры),
+    --matrix прогоняет все режимы подряд.
+
+    Запуск: python bench/voicemod_bench.py --chats 200 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import functools
+import http.server
+import importlib.util
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+import wave
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "voicemod_bench_host"
+
+# Ответы, по которым команда считается проваленной
+FAILURE_STRINGS = (
+    "error",
+    "no_pytgcalls",
+    "not_in_call",
+    "not_found",
+    "not_recognized",
+    "playlist_empty",
+    "no_mixer",
+    "superseded",
+)
+
+# Подставной воркер шарда: отвечает на запросы с задержкой PyTgCalls
+SHARD_WORKER = """
+import asyncio
+import json
+import sys
+
+LATENCY = %r
+
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    await reader.readline()
+    print(json.dumps({"event": "ready"}), flush=True)
+
+    async def handle(request):
+        await asyncio.sleep(LATENCY)
+        print(json.dumps({"id": request["id"]}), flush=True)
+
+    tasks = set()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        task = asyncio.ensure_future(handle(json.loads(line)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+asyncio.run(serve())
+"""
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def make_wav(path: str, seconds: float = 3.0):
+    """Синусоида 440 Гц, 48 кГц моно"""
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(48000)
+        wav.writeframes(
+            b"".join(
+                struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / 48000)))
+                for i in range(int(48000 * seconds))
+            )
+        )
+
+
+# ---------------------------------------------------------------- loader/utils
+
+
+class Validator:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class ConfigValue:
+    def __init__(self, option, default, doc=None, validator=None):
+        self.option = option
+        self.default = default
+
+
+class ModuleConfig(dict):
+    def __init__(self, *values):
+        super().__init__({value.option: value.default for value in values})
+
+
+class Strings:
+    def __init__(self, strings: dict):
+        self._strings = strings
+
+    def __call__(self, key: str) -> str:
+        return self._strings[key]
+
+    def __getitem__(self, key: str) -> str:
+        return self._strings[key]
+
+
+class Module:
+    pass
+
+
+def tds(cls):
+    cls.strings = Strings(cls.strings)
+    return cls
+
+
+def command(**kwargs):
+    return lambda func: func
+
+
+def loop(**kwargs):
+    # Фоновые циклы в бенчмарке не запускаются
+    return lambda func: func
+
+
+def build_loader() -> types.ModuleType:
+    loader = types.ModuleType(f"{HOST}.loader")
+    loader.Module = Module
+    loader.tds = tds
+    loader.command = command
+    loader.loop = loop
+    loader.ModuleConfig = ModuleConfig
+    loader.ConfigValue = ConfigValue
+    loader.validators = types.SimpleNamespace(
+        Integer=Validator, String=Validator, Boolean=Validator, Float=Validator
+    )
+    return loader
+
+
+def build_utils(edit_latency: float) -> types.ModuleType:
+    utils = types.ModuleType(f"{HOST}.utils")
+
+    def get_args_raw(message) -> str:
+        parts = message.text.split(maxsplit=1)
+        return parts[1] if len(parts) > 1 else ""
+
+    async def answer(message, text, **kwargs):
+        await asyncio.sleep(edit_latency)
+        message.answers.append(text)
+        return message
+
+    utils.get_args_raw = get_args_raw
+    utils.get_chat_id = lambda message: message.chat_id
+    utils.answer = answer
+    utils.escape_html = lambda text: str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return utils
+
+
+# ---------------------------------------------------------------- telethon
+
+
+class PeerChannel:
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+
+
+class PeerChat:
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+
+
+class InputPeerChannel:
+    def __init__(self, channel_id: int, access_hash: int):
+        self.channel_id = channel_id
+        self.access_hash = access_hash
+
+    def to_dict(self) -> dict:
+        return {"_": "InputPeerChannel", "channel_id": self.channel_id, "access_hash": self.access_hash}
+
+
+class StringSession:
+    @staticmethod
+    def save(session) -> str:
+        return ""
+
+
+class InputDocument:
+    def __init__(self, id: int, access_hash: int, file_reference: bytes):
+        self.id = id
+        self.access_hash = access_hash
+        self.file_reference = file_reference
+
+
+def build_telethon():
+    telethon = types.ModuleType("telethon")
+    telethon_types = types.ModuleType("telethon.types")
+    telethon_types.Message = FakeMessage
+    telethon_types.PeerChannel = PeerChannel
+    telethon_types.PeerChat = PeerChat
+    telethon_types.InputDocument = InputDocument
+    telethon.types = telethon_types
+    sessions = types.ModuleType("telethon.sessions")
+    sessions.StringSession = StringSession
+    telethon.sessions = sessions
+    return {"telethon": telethon, "telethon.types": telethon_types, "telethon.sessions": sessions}
+
+
+class FakeFile:
+    def __init__(self, doc_id: int, size: int):
+        self.id = doc_id
+        self.size = size
+        self.duration = 3
+        self.ext = ".wav"
+        self.title = f"track {doc_id}"
+        self.name = f"track{doc_id}.wav"
+        self.mime_type = "audio/x-wav"
+
+
+class FakeDocument:
+    def __init__(self, doc_id: int):
+        self.id = doc_id
+        self.access_hash = doc_id * 7919
+
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, client: "FakeClient", chat_id: int, text: str, reply=None, audio_path=None):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+        self.client = client
+        self.chat_id = chat_id
+        self.peer_id = PeerChannel(chat_id)
+        self.text = text
+        self.answers: List[str] = []
+        self._reply = reply
+        self._audio_path = audio_path
+        if audio_path:
+            doc_id = random.randrange(1, 2**31)
+            self.document = FakeDocument(doc_id)
+            self.file = FakeFile(doc_id, os.path.getsize(audio_path))
+            self.audio = self.media = self.document
+        else:
+            self.document = self.file = self.audio = self.media = None
+
+    async def get_reply_message(self):
+        return self._reply
+
+    async def delete(self):
+        pass
+
+    async def download_media(self, file=None, progress_callback=None):
+        await asyncio.sleep(self.client.latency)
+        shutil.copyfile(self._audio_path, file)
+        if progress_callback:
+            progress_callback(self.file.size, self.file.size)
+        return file
+
+
+class FakeClient:
+    """Клиент Telegram с настраиваемой задержкой запросов"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests: Dict[str, int] = {}
+        self.session = None
+        self.api_id = 0
+        self.api_hash = ""
+        self._handlers = []
+
+    def _count(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    async def get_entity(self, peer):
+        self._count("get_entity")
+        await asyncio.sleep(self.latency)
+        return types.SimpleNamespace(id=getattr(peer, "channel_id", 1), broadcast=False, megagroup=True)
+
+    async def get_input_entity(self, peer):
+        self._count("get_input_entity")
+        return InputPeerChannel(abs(peer) % 10**12, 1)
+
+    async def inline_query(self, bot, query):
+        self._count("inline_query")
+        await asyncio.sleep(self.latency)
+        document = FakeDocument(abs(hash(query)) % 2**31)
+        document.file_reference = b"ref"
+        return [types.SimpleNamespace(result=types.SimpleNamespace(document=document))]
+
+    async def send_file(self, *args, **kwargs):
+        self._count("send_file")
+        await asyncio.sleep(self.latency)
+
+    async def iter_download(self, media, offset=0, request_size=128 * 1024, limit=None, **kwargs):
+        self._count("iter_download")
+        with open(media._path, "rb") as f:
+            f.seek(offset)
+            while limit is None or limit > 0:
+                await asyncio.sleep(self.latency)
+                chunk = f.read(request_size)
+                if not chunk:
+                    return
+                yield chunk
+                if limit is not None:
+                    limit -= 1
+
+    def list_event_handlers(self):
+        return list(self._handlers)
+
+    def add_event_handler(self, callback, event=None):
+        self._handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self._handlers.remove((callback, event))
+
+
+class FakeDB(dict):
+    def get(self, owner, key, default=None):
+        return super().get((owner, key), default)
+
+    def set(self, owner, key, value):
+        self[(owner, key)] = value
+
+
+# ---------------------------------------------------------------- pytgcalls
+
+
+def build_pytgcalls(latency: float):
+    pytgcalls = types.ModuleType("pytgcalls")
+    pytgcalls.__file__ = os.path.join(tempfile.gettempdir(), "pytgcalls", "__init__.py")
+    filters = types.ModuleType("pytgcalls.filters")
+    call_types = types.ModuleType("pytgcalls.types")
+    raw = types.ModuleType("pytgcalls.types.raw")
+
+    class PyTgCalls:
+        def __init__(self, client):
+            self.client = client
+            self.calls: Dict[int, object] = {}
+            self.frames = 0
+
+        def on_update(self, flt=None):
+            return lambda func: func
+
+        async def start(self):
+            await asyncio.sleep(latency)
+
+        async def play(self, chat_id, stream):
+            await asyncio.sleep(latency)
+            self.calls[chat_id] = stream
+
+        async def leave_call(self, chat_id):
+            await asyncio.sleep(latency)
+            self.calls.pop(chat_id, None)
+
+        async def _noop(self, chat_id):
+            await asyncio.sleep(latency)
+
+        pause = resume = mute = unmute = _noop
+
+        async def change_volume_call(self, chat_id, volume):
+            await asyncio.sleep(latency)
+
+        async def send_frame(self, chat_id, device, frame, *args):
+            self.frames += 1
+
+    class MediaStream:
+        class Flags:
+            IGNORE = "ignore"
+            AUTO_DETECT = "auto"
+
+        def __init__(self, media_path, *args, **kwargs):
+            self.media_path = media_path
+            self.kwargs = kwargs
+
+    pytgcalls.PyTgCalls = PyTgCalls
+    filters.stream_end = lambda: None
+    filters.chat_update = lambda flags: None
+    pytgcalls.filters = filters
+    call_types.MediaStream = MediaStream
+    call_types.ChatUpdate = types.SimpleNamespace(Status=types.SimpleNamespace(LEFT_CALL=1))
+    call_types.ExternalMedia = types.SimpleNamespace(AUDIO="audio")
+    call_types.Device = types.SimpleNamespace(MICROPHONE="microphone")
+    raw.AudioParameters = lambda **kwargs: kwargs
+    call_types.raw = raw
+    pytgcalls.types = call_types
+    return {
+        "pytgcalls": pytgcalls,
+        "pytgcalls.filters": filters,
+        "pytgcalls.types": call_types,
+        "pytgcalls.types.raw": raw,
+    }
+
+
+def build_shazamio(latency: float):
+    shazamio = types.ModuleType("shazamio")
+
+    class Shazam:
+        async def recognize(self, data):
+            await asyncio.sleep(latency)
+            return {"track": {"title": "Bench", "subtitle": "VoiceMod", "images": {}}}
+
+    shazamio.Shazam = Shazam
+    return {"shazamio": shazamio}
+
+
+def build_fake_ytdl(latency: float):
+    """Подставной yt_dlp: блокирующие задержки, как у настоящего"""
+    yt_dlp = types.ModuleType("yt_dlp")
+
+    class YoutubeDL:
+        def __init__(self, opts):
+            self.opts = opts
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def extract_info(self, url, download=True, process=True):
+            time.sleep(latency)
+            return {
+                "id": os.path.basename(url),
+                "extractor_key": "Generic",
+                "ext": "mp3",
+                "url": url,
+                "title": url,
+                "http_headers": {},
+            }
+
+        def process_ie_result(self, info, download=True):
+            if not download:
+                return info
+            time.sleep(latency * 4)
+            path = self.opts["outtmpl"] % info
+            with open(path, "wb") as f:
+                f.write(b"\0" * 1024)
+            info["requested_downloads"] = [{"filepath": path}]
+            return info
+
+    utils = types.ModuleType("yt_dlp.utils")
+
+    class DownloadCancelled(Exception):
+        pass
+
+    utils.DownloadCancelled = DownloadCancelled
+    yt_dlp.YoutubeDL = YoutubeDL
+    yt_dlp.utils = utils
+    return {"yt_dlp": yt_dlp, "yt_dlp.utils": utils}
+
+
+# ---------------------------------------------------------------- harness
+
+
+def serve_audio(directory: str) -> str:
+    """Локальный HTTP-сервер с аудиофайлами для yt-dlp"""
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=directory)
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def load_module(args, workdir: str, mode: str = "default"):
+    host = types.ModuleType(HOST)
+    host.__path__ = []
+    host.loader = build_loader()
+    host.utils = build_utils(args.edit_latency)
+    modules = types.ModuleType(f"{HOST}.modules")
+    modules.__path__ = []
+
+    sys.modules.update({
+        HOST: host,
+        f"{HOST}.loader": host.loader,
+        f"{HOST}.utils": host.utils,
+        f"{HOST}.modules": modules,
+    })
+    sys.modules.update(build_telethon())
+    sys.modules.update(build_pytgcalls(args.latency))
+    sys.modules.update(build_shazamio(args.latency))
+
+    # При --matrix модуль грузится заново: подставной yt_dlp прошлого прогона — не настоящий
+    if getattr(sys.modules.get("yt_dlp"), "__spec__", True) is None:
+        sys.modules.pop("yt_dlp")
+        sys.modules.pop("yt_dlp.utils", None)
+    real_ytdl = importlib.util.find_spec("yt_dlp") is not None and not args.fake_ytdl
+    if not real_ytdl:
+        sys.modules.update(build_fake_ytdl(args.latency))
+
+    spec = importlib.util.spec_from_file_location(
+        f"{HOST}.modules.voicemod", os.path.join(ROOT, "voicemod.py")
+    )
+    voicemod = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = voicemod
+    spec.loader.exec_module(voicemod)
+
+    mod = voicemod.VoiceModMod()
+    mod.config["cache_dir"] = os.path.join(workdir, "cache")
+    mod.config["stream_mode"] = not args.download
+    mod.config["lazy_init"] = mode == "lazy_init"
+    mod.config["mixer"] = mode == "mixer"
+    if mode == "shards":
+        script = os.path.join(workdir, "shard_worker.py")
+        with open(script, "w") as f:
+            f.write(SHARD_WORKER % (args.latency,))
+        mod.config["shards"] = args.shards
+        # Вместо воркеров с настоящим PyTgCalls запускаются подставные
+        mod._shard_script = lambda: script
+    return mod, real_ytdl
+
+
+class StallMonitor:
+    """Меряет, насколько поздно просыпается event loop"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stalls: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.stalls.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def timed(latencies: Dict[str, List[float]], commands: list, name: str, handler, message):
+    start = time.perf_counter()
+    error = None
+    try:
+        await handler(message)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    latencies.setdefault(name, []).append(time.perf_counter() - start)
+    commands.append((name, message, error))
+
+
+def count_failures(mod, commands: list) -> Dict[str, int]:
+    """Команды, которые упали или ответили текстом ошибки"""
+    prefixes = [mod.strings(key).split("{")[0] for key in FAILURE_STRINGS]
+    failures: Dict[str, int] = {}
+    for name, message, error in commands:
+        reason = error or next(
+            (text for text in message.answers if any(text.startswith(p) for p in prefixes)),
+            None,
+        )
+        if reason:
+            if name not in failures:
+                print(f"{name} failed: {reason}", file=sys.stderr)
+            failures[name] = failures.get(name, 0) + 1
+    return failures
+
+
+async def run(args, mode: str):
+    do_ffmpeg = shutil.which("ffmpeg") is not None
+    if mode == "mixer" and not do_ffmpeg:
+        return {"mode": mode, "skipped": "no ffmpeg"}
+
+    workdir = tempfile.mkdtemp(prefix="voicemod-bench-")
+    media = os.path.join(workdir, "media")
+    os.makedirs(media)
+    for i in range(args.tracks):
+        make_wav(os.path.join(media, f"track{i}.wav"), seconds=1.0)
+    base_url = serve_audio(media)
+
+    mod, real_ytdl = load_module(args, workdir, mode)
+    voicemod = sys.modules[f"{HOST}.modules.voicemod"]
+    client = FakeClient(args.latency)
+    await mod.client_ready(client, FakeDB())
+
+    latencies: Dict[str, List[float]] = {}
+    commands: list = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def session(chat_id: int):
+        async with semaphore:
+            track = random.randrange(args.tracks)
+            url = f"{base_url}/track{track}.wav"
+            await timed(latencies, commands, "vjoin", mod.vjoincmd, FakeMessage(client, chat_id, ".vjoin"))
+            await timed(
+                latencies, commands, "vplay", mod.vplaycmd, FakeMessage(client, chat_id, f".vplay {chat_id} {url}")
+            )
+            if do_ffmpeg:
+                path = os.path.join(media, f"track{track}.wav")
+                reply = FakeMessage(client, chat_id, "", audio_path=path)
+                reply.media._path = path
+                await timed(
+                    latencies, commands, "shazam", mod.shazamcmd, FakeMessage(client, chat_id, ".shazam", reply=reply)
+                )
+            await timed(latencies, commands, "vstop", mod.vstopcmd, FakeMessage(client, chat_id, ".vstop"))
+
+    monitor = StallMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        await asyncio.gather(*(session(1000 + i) for i in range(args.chats)))
+    elapsed = time.perf_counter() - start
+    await monitor.stop()
+    # Итоговые тексты статус-сообщений дописываются в фоне
+    await asyncio.sleep(voicemod.PROGRESS_INTERVAL + 4 * args.latency)
+    failures = count_failures(mod, commands)
+    await mod.on_unload()
+
+    report = {
+        "mode": mode,
+        "yt_dlp": "real" if real_ytdl else "fake",
+        "shazam": "on" if do_ffmpeg else "skipped (no ffmpeg)",
+        "chats": args.chats,
+        "rounds": args.rounds,
+        "elapsed_s": round(elapsed, 3),
+        "commands_per_s": round(sum(len(v) for v in latencies.values()) / elapsed, 1),
+        "commands_ms": {
+            name: {
+                "p50": round(percentile(values, 0.5) * 1000, 1),
+                "p95": round(percentile(values, 0.95) * 1000, 1),
+                "p99": round(percentile(values, 0.99) * 1000, 1),
+                "n": len(values),
+                "failed": failures.get(name, 0),
+            }
+            for name, values in sorted(latencies.items())
+        },
+        "loop_stall_ms": {
+            "p50": round(percentile(monitor.stalls, 0.5) * 1000, 2),
+            "p99": round(percentile(monitor.stalls, 0.99) * 1000, 2),
+            "max": round(max(monitor.stalls, default=0) * 1000, 2),
+        },
+        "client_requests": client.requests,
+        "module_stats": mod._stats.snapshot(),
+    }
+    shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def print_report(report: dict):
+    if report.get("skipped"):
+        print(f"[{report['mode']}] skipped: {report['skipped']}")
+        return
+
+    print(f"[{report['mode']}] yt-dlp: {report['yt_dlp']}, shazam: {report['shazam']}")
+    print(f"{report['chats']} chats x {report['rounds']} rounds in {report['elapsed_s']} s "
+          f"({report['commands_per_s']} commands/s)")
+    for name, t in report["commands_ms"].items():
+        print(f"  {name:<14} p50 {t['p50']:>8} ms  p95 {t['p95']:>8} ms  p99 {t['p99']:>8} ms  "
+              f"n={t['n']}  failed={t['failed']}")
+    stall = report["loop_stall_ms"]
+    print(f"loop stall: p50 {stall['p50']} ms, p99 {stall['p99']} ms, max {stall['max']} ms")
+    print(f"client requests: {report['client_requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=200, help="сколько чатов")
+    parser.add_argument("--rounds", type=int, default=1, help="сколько раз прогнать все чаты")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных сессий")
+    parser.add_argument("--tracks", type=int, default=8, help="разных треков")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка Telegram/PyTgCalls, с")
+    parser.add_argument("--edit-latency", type=float, default=0.005, help="задержка редактирования, с")
+    parser.add_argument("--download", action="store_true", help="качать треки вместо потока")
+    parser.add_argument("--fake-ytdl", action="store_true", help="не использовать настоящий yt-dlp")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument("--lazy-init", action="store_true", help="PyTgCalls поднимается первой командой")
+    modes.add_argument("--mixer", action="store_true", help="играть через встроенный микшер")
+    modes.add_argument("--shards", type=int, default=0, help="сколько подставных воркеров PyTgCalls")
+    modes.add_argument("--matrix", action="store_true", help="прогнать все режимы подряд")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    args = parser.parse_args()
+
+    if args.matrix:
+        args.shards = 2
+        selected = ["default", "lazy_init", "mixer", "shards"]
+    elif args.lazy_init:
+        selected = ["lazy_init"]
+    elif args.mixer:
+        selected = ["mixer"]
+    elif args.shards:
+        selected = ["shards"]
+    else:
+        selected = ["default"]
+
+    reports = [asyncio.run(run(args, mode)) for mode in selected]
+    if args.json:
+        print(json.dumps(reports if args.matrix else reports[0], indent=1, default=str))
+    else:
+        for report in reports:
+            print_report(report)
+
+    # Провал любой команды — ненулевой код выхода, чтобы регрессия не выглядела ускорением
+    if any(t["failed"] for report in reports for t in report.get("commands_ms", {}).values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
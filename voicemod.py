@@ -9,23 +9,1303 @@ __version__ = (3, 0, 0)
 # meta developer: @samuray43k @ai
 # meta pic: https://img.icons8.com/fluency/512/microphone.png
 # scope: hikka_only
-# requires: ffmpeg-python yt-dlp shazamio py-tgcalls
+# requires: ffmpeg-python yt-dlp shazamio py-tgcalls numpy
 
+import io
 import os
 import re
+import sys
+import json
+import glob
+import heapq
+import hashlib
+import itertools
+import marshal
+import threading
+import importlib.abc
+import importlib.util
 import logging
 import asyncio
 import tempfile
+import time
 import wave
-from typing import Dict, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from .. import loader, utils
 
 # Импорты через telethon — Heroku автоматически подменит на herokutl
-from telethon.types import Message
+from telethon.types import InputDocument, Message, PeerChannel, PeerChat
 
 logger = logging.getLogger(__name__)
 
+# Ошибки, после которых закэшированный chat_id считается устаревшим
+PEER_ERRORS = {
+    "PeerIdInvalidError",
+    "ChannelInvalidError",
+    "ChannelPrivateError",
+    "ChatIdInvalidError",
+    "ChatForbiddenError",
+}
+
+# Shazam хватает нескольких секунд: качаем и декодируем только их
+SHAZAM_SECONDS = 12
+SHAZAM_SAMPLE_RATE = 16000
+SHAZAM_FALLBACK_BYTES = 4 * 1024 * 1024
+SHAZAM_REQUEST_SIZE = 128 * 1024
+SHAZAM_CACHE_SIZE = 1000
+# Скан длинной записи: окна по SHAZAM_SECONDS с шагом SCAN_STEP (окна перекрываются)
+SCAN_STEP = 10
+# Хвост записи короче этого в отдельное окно не идёт
+SCAN_MIN_TAIL = 4
+
+# Меняется при изменении патча — сбрасывает закэшированный код
+HEROKUTL_PATCH_VERSION = 1
+
+# Формат PCM, который станции раздают в звонки: 48 кГц, стерео, 16 бит
+PCM_SAMPLE_RATE = 48000
+PCM_CHANNELS = 2
+FRAME_MS = 10
+FRAME_BYTES = PCM_SAMPLE_RATE * PCM_CHANNELS * 2 * FRAME_MS // 1000
+# Сколько кадров декодер читает с запасом сверх длины кроссфейда
+MIXER_LOOKAHEAD_FRAMES = 50
+
+# Сколько последних замеров хранит каждая гистограмма
+STATS_WINDOW = 512
+
+# Размер части при параллельном скачивании из Telegram (максимум для upload.getFile)
+DOWNLOAD_PART_SIZE = 512 * 1024
+# Файлы меньше этого качаются обычным download_media
+PARALLEL_DOWNLOAD_MIN_SIZE = 4 * DOWNLOAD_PART_SIZE
+
+# Через сколько секунд file_reference из кэша .sm обновляется в фоне
+SM_REFRESH_AGE = 6 * 3600
+
+# Сколько недавно сыгранных потоком ссылок помнить, чтобы узнать повторное воспроизведение
+STREAMED_LINKS_SIZE = 1000
+
+# Нормализованная версия трека: 48 кГц стерео Opus с выравниванием громкости
+LOUDNORM_FILTER = "loudnorm=I=-16:TP=-1.5:LRA=11"
+NORMALIZED_BITRATE = "128k"
+
+# Ссылки, которые yt-dlp разворачивает в список треков
+PLAYLIST_TYPES = ("playlist", "multi_video")
+
+# Статус-сообщение редактируется не чаще раза в столько секунд
+PROGRESS_INTERVAL = 2.0
+
+# Выход из звонков при выгрузке модуля не должен её задерживать
+UNLOAD_LEAVE_TIMEOUT = 5
+
+# Шардинг: чаты раскладываются по процессам-воркерам со своим PyTgCalls
+LOCAL_SHARD = -1
+SHARD_START_TIMEOUT = 60
+SHARD_REQUEST_TIMEOUT = 30
+SHARD_RESTART_DELAY = 1
+SHARD_RESTART_MAX_DELAY = 30
+SHARD_OPS = ("play", "leave_call", "pause", "resume", "mute", "unmute", "change_volume_call")
+
+# Воркер получает сессию первой строкой stdin, дальше — команды и события JSON-строками
+SHARD_WORKER_SOURCE = '''
+import asyncio
+import json
+import logging
+import sys
+
+OPS = %r
+
+
+async def main():
+    # Всё, что библиотеки пишут в stdout, уходит в stderr — stdout занят протоколом
+    out, sys.stdout = sys.stdout, sys.stderr
+    
+    def send(payload):
+        out.write(json.dumps(payload) + "\\n")
+        out.flush()
+    
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    init = json.loads(await reader.readline())
+    
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+    from telethon.tl import types
+    from pytgcalls import PyTgCalls, filters
+    from pytgcalls.types import MediaStream
+    
+    # Апдейты продолжает получать только основной клиент
+    client = TelegramClient(
+        StringSession(init["session"]),
+        init["api_id"],
+        init["api_hash"],
+        receive_updates=False,
+    )
+    await client.connect()
+    call_py = PyTgCalls(client)
+    
+    @call_py.on_update(filters.stream_end())
+    async def stream_end(_, update):
+        send({"event": "stream_end", "chat_id": update.chat_id})
+    
+    await call_py.start()
+    send({"event": "ready"})
+    
+    def remember(peer):
+        # В StringSession нет кэша сущностей, а апдейты воркер не получает:
+        # без access_hash из основного клиента супергруппу не найти
+        if peer:
+            client.session.process_entities([getattr(types, peer["type"])(**peer["fields"])])
+    
+    async def handle(request):
+        try:
+            if request["op"] not in OPS:
+                raise ValueError(request["op"])
+            remember(request.get("peer"))
+            if request["op"] == "play":
+                offset = request.get("offset")
+                await call_py.play(
+                    request["chat_id"],
+                    MediaStream(
+                        request["source"],
+                        video_flags=MediaStream.Flags.IGNORE,
+                        headers=request.get("headers"),
+                        ffmpeg_parameters="-ss %%.1f" %% offset if offset else None,
+                    ),
+                )
+            else:
+                await getattr(call_py, request["op"])(request["chat_id"], *request.get("args", ()))
+            send({"id": request["id"]})
+        except Exception as e:
+            send({"id": request["id"], "error": type(e).__name__, "message": str(e)})
+    
+    tasks = set()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        task = asyncio.ensure_future(handle(json.loads(line)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+asyncio.run(main())
+''' % (SHARD_OPS,)
+
+
+class HerokutlClientFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Собирает pytgcalls.mtproto.herokutl_client из telethon_client.py в памяти.
+    Скомпилированный код кэшируется по хэшу исходника"""
+
+    voicemod_patch = True
+    fullname = "pytgcalls.mtproto.herokutl_client"
+
+    def __init__(self, src: str, cache_dir: str):
+        self._src = src
+        self._cache_dir = cache_dir
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname != self.fullname:
+            return None
+        return importlib.util.spec_from_loader(fullname, self, origin=self._src)
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        module.__file__ = self._src
+        exec(self._get_code(), module.__dict__)
+
+    def _get_code(self):
+        with open(self._src, "rb") as f:
+            source = f.read()
+        
+        digest = hashlib.sha256(
+            source + f"{HEROKUTL_PATCH_VERSION}:{sys.version}".encode()
+        ).hexdigest()[:16]
+        cached = os.path.join(self._cache_dir, f"herokutl_client-{digest}.bin")
+        
+        # Исходник не менялся — патч и компиляция не нужны
+        if os.path.exists(cached):
+            try:
+                with open(cached, "rb") as f:
+                    return marshal.load(f)
+            except Exception:
+                pass
+        
+        code = compile(self.patch(source.decode()), self._src, "exec")
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(cached, "wb") as f:
+                marshal.dump(code, f)
+        except OSError as e:
+            logger.debug(f"Could not cache patched herokutl_client: {e}")
+        
+        return code
+
+    @staticmethod
+    def patch(content: str) -> str:
+        """Заменяет telethon на herokutl и чинит обработку UpdateGroupCall"""
+        content = content.replace('from telethon', 'from herokutl')
+        content = content.replace('import telethon', 'import herokutl')
+        
+        # ГЛАВНЫЙ ПАТЧ: полностью переписываем обработку UpdateGroupCall
+        # herokutl имеет peer вместо chat_id
+        # Отступы: 12 пробелов для основного блока, 16 для вложенного
+        old_block = """            if isinstance(
+                update,
+                UpdateGroupCall,
+            ):
+                chat_id = self.chat_id(
+                    await self._get_entity_group(
+                        update.chat_id,
+                    ),
+                )"""
+        
+        new_block = """            if isinstance(
+                update,
+                UpdateGroupCall,
+            ):
+                # herokutl compatibility patch
+                try:
+                    if hasattr(update, 'peer') and update.peer:
+                        if hasattr(update.peer, 'channel_id'):
+                            raw_id = update.peer.channel_id
+                        elif hasattr(update.peer, 'chat_id'):
+                            raw_id = update.peer.chat_id
+                        else:
+                            return
+                    elif hasattr(update, 'chat_id'):
+                        raw_id = update.chat_id
+                    else:
+                        return
+                    chat_id = self.chat_id(
+                        await self._get_entity_group(raw_id),
+                    )
+                except Exception:
+                    return"""
+        
+        return content.replace(old_block, new_block)
+
+
+class Stats:
+    """Скользящие гистограммы задержек по этапам и счётчики событий"""
+
+    def __init__(self):
+        self.timings: Dict[str, deque] = {}
+        self.counters: Dict[str, int] = {}
+
+    def observe(self, stage: str, seconds: float):
+        self.timings.setdefault(stage, deque(maxlen=STATS_WINDOW)).append(seconds)
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_error(self, error: Exception):
+        self.incr(f"error.{type(error).__name__}")
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def percentiles(self, stage: str) -> Tuple[float, float, float]:
+        """p50, p95, p99 в секундах"""
+        values = sorted(self.timings[stage])
+        pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        return pick(0.5), pick(0.95), pick(0.99)
+
+    def snapshot(self) -> dict:
+        return {
+            "timings": {
+                stage: dict(
+                    zip(("p50", "p95", "p99"), self.percentiles(stage)),
+                    count=len(values),
+                )
+                for stage, values in self.timings.items()
+                if values
+            },
+            "counters": dict(self.counters),
+        }
+
+
+class ChunkedDownload:
+    """Скачивает документ из Telegram частями параллельно в заранее выделенный файл.
+    Готовое начало файла можно читать, не дожидаясь конца загрузки"""
+
+    def __init__(
+        self,
+        client,
+        media,
+        size: int,
+        path: str,
+        workers: int,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+    ):
+        self.path = path
+        self.size = size
+        self._client = client
+        self._media = media
+        self._workers = workers
+        self._progress = progress
+        self._parts = -(-size // DOWNLOAD_PART_SIZE)
+        self._next_part = 0
+        self._done = [False] * self._parts
+        self._ready_parts = 0
+        self._downloaded = 0
+        self._error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        
+        # Файл выделяется целиком сразу, чтобы iter_ready мог открыть его до run()
+        with open(self.path, "wb") as f:
+            f.truncate(self.size)
+
+    @property
+    def ready_bytes(self) -> int:
+        """Сколько байт с начала файла уже скачано подряд"""
+        return min(self._ready_parts * DOWNLOAD_PART_SIZE, self.size)
+
+    async def run(self) -> str:
+        # Части пишутся на свои места в выделенном файле
+        fd = os.open(self.path, os.O_WRONLY)
+        workers = [
+            asyncio.ensure_future(self._worker(fd))
+            for _ in range(min(self._workers, self._parts))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException as e:
+            self._error = e
+            raise
+        finally:
+            # При ошибке одной части остальные ещё пишут в fd — дожидаемся их,
+            # иначе они попадут в чужой файл, получивший тот же номер дескриптора
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            os.close(fd)
+            self._changed.set()
+        
+        return self.path
+
+    async def _worker(self, fd: int):
+        # Части раздаются по порядку, чтобы начало файла было готово раньше
+        while self._next_part < self._parts:
+            part = self._next_part
+            self._next_part += 1
+            
+            data = b"".join([
+                chunk
+                async for chunk in self._client.iter_download(
+                    self._media,
+                    offset=part * DOWNLOAD_PART_SIZE,
+                    request_size=DOWNLOAD_PART_SIZE,
+                    limit=1,
+                    file_size=self.size,
+                )
+            ])
+            os.pwrite(fd, data, part * DOWNLOAD_PART_SIZE)
+            
+            self._done[part] = True
+            while self._ready_parts < self._parts and self._done[self._ready_parts]:
+                self._ready_parts += 1
+            
+            self._downloaded += len(data)
+            if self._progress:
+                self._progress("downloading", self._downloaded / self.size)
+            self._changed.set()
+
+    async def iter_ready(self) -> AsyncIterator[bytes]:
+        """Отдаёт файл по порядку по мере того, как докачиваются части"""
+        sent = 0
+        with open(self.path, "rb") as f:
+            while sent < self.size:
+                self._changed.clear()
+                ready = self.ready_bytes
+                if ready > sent:
+                    yield os.pread(f.fileno(), ready - sent, sent)
+                    sent = ready
+                elif self._error:
+                    raise self._error
+                else:
+                    await self._changed.wait()
+
+
+class Job:
+    """Задача планировщика: одна на ключ, сколько бы команд её ни ждали"""
+
+    def __init__(self, key: str, factory: Callable[[threading.Event], Awaitable], priority: int):
+        self.key = key
+        self.factory = factory
+        self.priority = priority
+        self.owners: Set[Any] = set()
+        self.future = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        # Флаг для кода в потоках (yt-dlp), который нельзя отменить через task.cancel()
+        self.cancel_event = threading.Event()
+
+
+class Scheduler:
+    """Общий планировщик загрузок и перекодирования.
+    Ограничивает число одновременных задач, запускает команды раньше предзагрузки,
+    склеивает одинаковые задачи и отменяет те, что больше никому не нужны"""
+
+    FOREGROUND = 0
+    PREFETCH = 1
+    BACKGROUND = 2
+
+    def __init__(self, slots: Callable[[], int]):
+        self._slots = slots
+        self._jobs: Dict[str, Job] = {}
+        self._heap: List[Tuple[int, int, Job]] = []
+        self._seq = 0
+        self._running = 0
+        self._running_background = 0
+
+    def submit(
+        self,
+        key: str,
+        factory: Callable[[threading.Event], Awaitable],
+        priority: int,
+        owner: Any = None,
+    ) -> asyncio.Future:
+        job = self._jobs.get(key)
+        if job is not None and job.cancel_event.is_set():
+            # Отменённая задача ещё доделывает уборку и её future уже никому не нужен.
+            # Новая начнётся после неё, чтобы они не делили временные файлы
+            factory = self._after(job.task, factory)
+            job = None
+        if job is None:
+            job = self._jobs[key] = Job(key, factory, priority)
+            job.future.add_done_callback(lambda future, job=job: self._log_failure(job, future))
+            self._push(job)
+        elif priority < job.priority and job.task is None:
+            # Ещё ждёт в очереди — поднимаем приоритет (старая запись станет неактуальной)
+            job.priority = priority
+            self._push(job)
+        
+        job.owners.add(owner)
+        self._dispatch()
+        return job.future
+
+    def cancel(self, owner: Any):
+        """Отменяет задачи владельца, если они больше никому не нужны"""
+        for job in list(self._jobs.values()):
+            if owner not in job.owners:
+                continue
+            
+            job.owners.discard(owner)
+            if job.owners:
+                continue
+            
+            job.cancel_event.set()
+            if job.task:
+                job.task.cancel()
+            else:
+                self._jobs.pop(job.key, None)
+                job.future.cancel()
+
+    async def close(self):
+        for job in list(self._jobs.values()):
+            job.cancel_event.set()
+            if job.task:
+                job.task.cancel()
+            else:
+                job.future.cancel()
+        self._jobs.clear()
+        self._heap.clear()
+
+    @staticmethod
+    def _after(
+        task: asyncio.Task,
+        factory: Callable[[threading.Event], Awaitable],
+    ) -> Callable[[threading.Event], Awaitable]:
+        async def run(cancel_event: threading.Event):
+            await asyncio.wait([task])
+            return await factory(cancel_event)
+        
+        return run
+
+    def _push(self, job: Job):
+        self._seq += 1
+        heapq.heappush(self._heap, (job.priority, self._seq, job))
+
+    def _pick(self) -> Optional[Job]:
+        # Один слот всегда остаётся командам пользователя
+        background_slots = max(1, self._slots() - 1)
+        while self._heap:
+            priority, _, job = self._heap[0]
+            if job.task or job.future.done() or priority != job.priority:
+                heapq.heappop(self._heap)
+                continue
+            if priority > self.FOREGROUND and self._running_background >= background_slots:
+                return None
+            heapq.heappop(self._heap)
+            return job
+        return None
+
+    def _dispatch(self):
+        while self._running < self._slots():
+            job = self._pick()
+            if not job:
+                break
+            
+            self._running += 1
+            if job.priority > self.FOREGROUND:
+                self._running_background += 1
+            
+            job.task = asyncio.ensure_future(job.factory(job.cancel_event))
+            job.task.add_done_callback(lambda task, job=job: self._finish(job, task))
+
+    def _finish(self, job: Job, task: asyncio.Task):
+        self._running -= 1
+        if job.priority > self.FOREGROUND:
+            self._running_background -= 1
+        if self._jobs.get(job.key) is job:
+            self._jobs.pop(job.key)
+        
+        if not job.future.done():
+            if task.cancelled():
+                job.future.cancel()
+            elif task.exception():
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+        
+        self._dispatch()
+
+    def _log_failure(self, job: Job, future: asyncio.Future):
+        # Ошибку получит тот, кто ждёт задачу; фоновые задачи никто не ждёт
+        if not future.cancelled() and future.exception() and job.priority == self.BACKGROUND:
+            logger.warning(f"Background job {job.key} failed: {future.exception()}")
+
+
+class Voice:
+    """Один декодер ffmpeg внутри станции: трек или наложение.
+    Кадры читаются с запасом, поэтому конец трека виден заранее"""
+
+    def __init__(
+        self,
+        proc: asyncio.subprocess.Process,
+        feed: Optional[AsyncIterator[bytes]],
+        lookahead: int,
+        gain: float = 1.0,
+    ):
+        self.proc = proc
+        self.gain = gain
+        self.ending_signalled = False
+        self.eof = False
+        self._target = gain
+        self._step = 0.0
+        self._lookahead = lookahead
+        self._frames: deque = deque()
+        self._space = asyncio.Event()
+        self._reader = asyncio.ensure_future(self._read_ahead())
+        self._feed_task = asyncio.ensure_future(self._feed(feed)) if feed else None
+
+    @property
+    def remaining(self) -> int:
+        """Кадров в буфере (после eof — до конца трека)"""
+        return len(self._frames)
+
+    @property
+    def done(self) -> bool:
+        return self.eof and not self._frames
+
+    def fade(self, target: float, frames: int):
+        """Плавно меняет громкость за frames кадров"""
+        self._target = target
+        self._step = (target - self.gain) / max(frames, 1)
+
+    def next_gain(self) -> Tuple[float, float]:
+        """Громкость в начале и в конце текущего кадра"""
+        start = self.gain
+        if self.gain != self._target:
+            self.gain += self._step
+            if (self._step > 0) == (self.gain >= self._target):
+                self.gain = self._target
+        return start, self.gain
+
+    def faded_out(self) -> bool:
+        return self.gain == self._target == 0
+
+    def next_frame(self) -> Optional[bytes]:
+        """Следующий кадр; None — декодер не успел (кадр будет тишиной)"""
+        if not self._frames:
+            return None
+        self._space.set()
+        return self._frames.popleft()
+
+    async def _read_ahead(self):
+        try:
+            while True:
+                while len(self._frames) >= self._lookahead:
+                    self._space.clear()
+                    await self._space.wait()
+                self._frames.append(await self.proc.stdout.readexactly(FRAME_BYTES))
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                self._frames.append(e.partial.ljust(FRAME_BYTES, b"\0"))
+        except Exception as e:
+            logger.warning(f"Decoder failed: {e}")
+        finally:
+            self.eof = True
+
+    async def _feed(self, feed: AsyncIterator[bytes]):
+        """Передаёт в ffmpeg данные, которые ещё докачиваются"""
+        try:
+            async for chunk in feed:
+                self.proc.stdin.write(chunk)
+                await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            logger.warning(f"Source feed failed: {e}")
+        finally:
+            if not self.proc.stdin.is_closing():
+                self.proc.stdin.close()
+
+    async def close(self):
+        for task in (self._reader, self._feed_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        
+        if self.proc.returncode is None:
+            self.proc.kill()
+            await self.proc.wait()
+        self._frames.clear()
+
+
+class Station:
+    """Микшер: декодеры ffmpeg (трек, уходящий при кроссфейде трек, наложения)
+    сводятся в один PCM-поток, который раздаётся в звонки со своей громкостью для каждого.
+    Любое изменение применяется со следующего кадра, звонок не перезапускается"""
+
+    def __init__(
+        self,
+        name: str,
+        calls: Callable[[], Any],
+        on_ending: Optional[Callable[["Station"], Awaitable]] = None,
+    ):
+        self.name = name
+        self.title: Optional[str] = None
+        self.chats: Set[int] = set()
+        self.paused = False
+        # За сколько секунд до конца трека звать on_ending (длина кроссфейда)
+        self.crossfade = 0.0
+        # PyTgCalls берётся на каждый кадр: ленивый режим может перезапустить его,
+        # пока станция играет
+        self._calls = calls
+        self._on_ending = on_ending
+        self._music: Optional[Voice] = None
+        self._fading: List[Voice] = []
+        self._overlays: List[Voice] = []
+        # chat_id -> (текущая громкость, целевая)
+        self._gains: Dict[int, Tuple[float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._ramp = None
+
+    async def play(
+        self,
+        source: Optional[str],
+        headers: Optional[dict],
+        title: str,
+        feed: Optional[AsyncIterator[bytes]] = None,
+        offset: float = 0,
+        crossfade: float = 0,
+    ):
+        """Переключает станцию на новый источник, не трогая подключённые чаты.
+        С feed декодер читает данные из stdin по мере их появления;
+        с crossfade старый трек затухает, пока новый нарастает"""
+        voice = await self._spawn(source, headers, feed, offset)
+        old, self._music = self._music, voice
+        self.title = title
+        
+        if old and crossfade and not old.done:
+            frames = int(crossfade * 1000 / FRAME_MS)
+            if old.eof:
+                frames = min(frames, old.remaining)
+            old.fade(0, frames)
+            self._fading.append(old)
+            voice.gain = 0
+            voice.fade(1, frames)
+        elif old:
+            await old.close()
+        
+        self._start_pump()
+
+    async def overlay(self, source: str, headers: Optional[dict], gain: float = 1.0):
+        """Накладывает звук (джингл, объявление) поверх текущего трека"""
+        self._overlays.append(await self._spawn(source, headers, None, 0, gain))
+        self._start_pump()
+
+    def set_gain(self, chat_id: int, gain: float):
+        current, _ = self._gains.get(chat_id, (1.0, 1.0))
+        self._gains[chat_id] = (current, gain)
+
+    async def _spawn(
+        self,
+        source: Optional[str],
+        headers: Optional[dict],
+        feed: Optional[AsyncIterator[bytes]],
+        offset: float,
+        gain: float = 1.0,
+    ) -> Voice:
+        args = ["ffmpeg", "-v", "quiet"]
+        if headers:
+            args += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+        if offset:
+            args += ["-ss", f"{offset:.1f}"]
+        args += [
+            "-i", "pipe:0" if feed else source,
+            "-f", "s16le", "-ac", str(PCM_CHANNELS), "-ar", str(PCM_SAMPLE_RATE),
+            "pipe:1",
+        ]
+        
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE if feed else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        # Запас чтения должен покрывать кроссфейд, иначе конец трека заметим поздно
+        lookahead = int(self.crossfade * 1000 / FRAME_MS) + MIXER_LOOKAHEAD_FRAMES
+        return Voice(proc, feed, lookahead, gain)
+
+    def _start_pump(self):
+        if not self._task or self._task.done():
+            self._task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self):
+        """Сводит и раздаёт кадры в реальном времени, пока есть что играть"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        
+        try:
+            while self._music or self._fading or self._overlays:
+                if not self.paused:
+                    await self._send(self._mix())
+                    await self._reap()
+                
+                deadline += FRAME_MS / 1000
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -1:
+                    # Event loop надолго подвис — не пытаемся догнать рывком
+                    deadline = loop.time()
+        except Exception as e:
+            logger.exception(f"Station {self.name} failed: {e}")
+            self.title = None
+
+    def _gain_ramp(self, start: float, end: float):
+        """Громкость по сэмплам кадра: без щелчков при изменении"""
+        if start == end:
+            return start
+        return start + (end - start) * self._ramp
+
+    def _mix(self):
+        import numpy as np
+        
+        if self._ramp is None:
+            self._ramp = np.linspace(0, 1, FRAME_BYTES // 2 // PCM_CHANNELS, dtype=np.float32)[:, None]
+        
+        mix = np.zeros((FRAME_BYTES // 2 // PCM_CHANNELS, PCM_CHANNELS), dtype=np.float32)
+        for voice in (self._music, *self._fading, *self._overlays):
+            if not voice:
+                continue
+            frame = voice.next_frame()
+            gain = self._gain_ramp(*voice.next_gain())
+            if frame is not None:
+                samples = np.frombuffer(frame, dtype=np.int16).reshape(-1, PCM_CHANNELS)
+                mix += samples * gain
+        
+        return mix
+
+    async def _reap(self):
+        """Убирает доигравшие декодеры и сообщает о скором конце трека"""
+        music = self._music
+        if music and not music.ending_signalled and music.eof:
+            if music.remaining <= self.crossfade * 1000 / FRAME_MS:
+                music.ending_signalled = True
+                if self._on_ending:
+                    task = asyncio.ensure_future(self._on_ending(self))
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        
+        if music and music.done and music is self._music:
+            self._music = None
+            self.title = None
+            await music.close()
+        
+        for voices in (self._fading, self._overlays):
+            for voice in [voice for voice in voices if voice.done or voice.faded_out()]:
+                voices.remove(voice)
+                await voice.close()
+
+    async def _send(self, mix):
+        import numpy as np
+        from pytgcalls.types import Device
+        
+        call_py = self._calls()
+        if call_py is None:
+            return
+        
+        # Чаты с одинаковой громкостью получают один и тот же кадр
+        groups: Dict[Tuple[float, float], List[int]] = {}
+        for chat_id in self.chats:
+            current, target = self._gains.get(chat_id, (1.0, 1.0))
+            groups.setdefault((current, target), []).append(chat_id)
+            if current != target:
+                self._gains[chat_id] = (target, target)
+        
+        sends = []
+        for (current, target), chats in groups.items():
+            frame = np.clip(mix * self._gain_ramp(current, target), -32768, 32767)
+            frame = frame.astype(np.int16).tobytes()
+            sends += [
+                (chat_id, call_py.send_frame(chat_id, Device.MICROPHONE, frame))
+                for chat_id in chats
+            ]
+        
+        results = await asyncio.gather(*(send for _, send in sends), return_exceptions=True)
+        for (chat_id, _), result in zip(sends, results):
+            if isinstance(result, Exception):
+                logger.debug(f"Station {self.name}: frame to {chat_id} failed: {result}")
+
+    async def stop(self):
+        """Останавливает декодеры; чаты остаются подключены"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        
+        for voice in (self._music, *self._fading, *self._overlays):
+            if voice:
+                await voice.close()
+        self._music = None
+        self._fading = []
+        self._overlays = []
+        self.title = None
+
+
+class ShardError(Exception):
+    """Ошибка, пришедшая из воркера; имя класса повторяет исходное"""
+
+
+_SHARD_ERRORS: Dict[str, type] = {}
+
+
+def _shard_error(name: str, message: str) -> ShardError:
+    # Имя класса сохраняется, чтобы работала классификация ошибок (PEER_ERRORS и т.п.)
+    if name not in _SHARD_ERRORS:
+        _SHARD_ERRORS[name] = type(name, (ShardError,), {})
+    return _SHARD_ERRORS[name](message)
+
+
+class Shard:
+    """Процесс-воркер со своим PyTgCalls. Помнит, что играет в каждом своём чате,
+    чтобы после падения зайти в них заново"""
+
+    def __init__(
+        self,
+        index: int,
+        script: str,
+        init: dict,
+        on_stream_end: Callable[[int], Awaitable],
+        on_exit: Callable[["Shard"], None],
+    ):
+        self.index = index
+        # chat_id -> (источник, заголовки); None — чат зашёл с тишиной (.vjoin):
+        # её временный файл удаляется сразу, при перезапуске нужен новый
+        self.streams: Dict[int, Optional[Tuple[str, Optional[dict]]]] = {}
+        # Input peer каждого чата: уходит с каждым запросом, в том числе после перезапуска
+        self.peers: Dict[int, dict] = {}
+        self._script = script
+        self._init = init
+        self._on_stream_end = on_stream_end
+        self._on_exit = on_exit
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._seq = 0
+
+    @property
+    def alive(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None
+
+    async def start(self):
+        self._proc = await asyncio.create_subprocess_exec(
+            sys.executable, self._script,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self._ready = asyncio.get_running_loop().create_future()
+        self._reader = asyncio.ensure_future(self._read())
+        self._write(self._init)
+        
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready), SHARD_START_TIMEOUT)
+        except BaseException:
+            await self.stop()
+            raise
+
+    async def stop(self):
+        if self._reader:
+            self._reader.cancel()
+            self._reader = None
+        
+        if self.alive:
+            self._proc.stdin.close()
+            try:
+                await asyncio.wait_for(self._proc.wait(), 5)
+            except asyncio.TimeoutError:
+                self._proc.kill()
+                await self._proc.wait()
+        
+        self._fail_pending(ConnectionError(f"shard {self.index} stopped"))
+
+    async def play(
+        self,
+        chat_id: int,
+        source: str,
+        headers: Optional[dict] = None,
+        offset: float = 0,
+        peer: Optional[dict] = None,
+        silent: bool = False,
+    ):
+        if peer:
+            self.peers[chat_id] = peer
+        await self._request("play", chat_id, source=source, headers=headers, offset=offset)
+        self.streams[chat_id] = None if silent else (source, headers)
+
+    async def leave_call(self, chat_id: int):
+        self.streams.pop(chat_id, None)
+        try:
+            await self._request("leave_call", chat_id)
+        finally:
+            self.peers.pop(chat_id, None)
+
+    async def pause(self, chat_id: int):
+        await self._request("pause", chat_id)
+
+    async def resume(self, chat_id: int):
+        await self._request("resume", chat_id)
+
+    async def mute(self, chat_id: int):
+        await self._request("mute", chat_id)
+
+    async def unmute(self, chat_id: int):
+        await self._request("unmute", chat_id)
+
+    async def change_volume_call(self, chat_id: int, volume: int):
+        await self._request("change_volume_call", chat_id, args=[volume])
+
+    async def _request(self, op: str, chat_id: int, **params):
+        self._seq += 1
+        request_id = self._seq
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            self._write({
+                "id": request_id,
+                "op": op,
+                "chat_id": chat_id,
+                "peer": self.peers.get(chat_id),
+                **params,
+            })
+            return await asyncio.wait_for(future, SHARD_REQUEST_TIMEOUT)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _write(self, payload: dict):
+        if not self.alive:
+            raise ConnectionError(f"shard {self.index} is not running")
+        self._proc.stdin.write((json.dumps(payload) + "\n").encode())
+
+    def _fail_pending(self, error: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        if self._ready and not self._ready.done():
+            self._ready.set_exception(error)
+
+    async def _read(self):
+        while True:
+            line = await self._proc.stdout.readline()
+            if not line:
+                break
+            
+            try:
+                payload = json.loads(line)
+            except ValueError:
+                continue
+            
+            if "id" in payload:
+                future = self._pending.get(payload["id"])
+                if not future or future.done():
+                    continue
+                if "error" in payload:
+                    future.set_exception(_shard_error(payload["error"], payload["message"]))
+                else:
+                    future.set_result(None)
+            elif payload.get("event") == "ready":
+                if not self._ready.done():
+                    self._ready.set_result(None)
+            elif payload.get("event") == "stream_end":
+                asyncio.ensure_future(self._on_stream_end(payload["chat_id"]))
+        
+        await self._proc.wait()
+        self._reader = None
+        self._fail_pending(ConnectionError(f"shard {self.index} exited"))
+        self._on_exit(self)
+
+
+class ShardPool:
+    """Воркеры PyTgCalls; чат закрепляется за воркером по хэшу chat_id.
+    Упавший воркер перезапускается и заходит в свои чаты заново"""
+
+    def __init__(
+        self,
+        count: int,
+        script: str,
+        init: dict,
+        on_stream_end: Callable[[int], Awaitable],
+        on_lost: Callable[[int], None],
+        silence: Callable[[], str],
+    ):
+        self._shards = [
+            Shard(index, script, init, on_stream_end, self._restart) for index in range(count)
+        ]
+        self._on_lost = on_lost
+        self._silence = silence
+        self._closing = False
+        self._revivals: Set[asyncio.Task] = set()
+        # Воркеры, которые уже перезапускаются: у каждого только один цикл перезапуска
+        self._reviving: Set[int] = set()
+
+    def __getitem__(self, index: int) -> Shard:
+        return self._shards[index]
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    def index_for(self, chat_id: int) -> int:
+        digest = hashlib.sha256(str(chat_id).encode()).digest()
+        return int.from_bytes(digest[:8], "big") % len(self._shards)
+
+    async def start(self):
+        try:
+            await asyncio.gather(*(shard.start() for shard in self._shards))
+        except BaseException:
+            await self.stop()
+            raise
+
+    async def stop(self):
+        self._closing = True
+        for task in self._revivals:
+            task.cancel()
+        await asyncio.gather(*(shard.stop() for shard in self._shards), return_exceptions=True)
+
+    def _restart(self, shard: Shard):
+        # Неудачный запуск внутри _revive тоже завершает процесс — это не новое падение
+        if self._closing or shard.index in self._reviving:
+            return
+        
+        self._reviving.add(shard.index)
+        task = asyncio.ensure_future(self._revive(shard))
+        self._revivals.add(task)
+        task.add_done_callback(self._revivals.discard)
+
+    async def _revive(self, shard: Shard):
+        logger.warning(f"Shard {shard.index} exited, restarting")
+        delay = SHARD_RESTART_DELAY
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await shard.start()
+                except Exception as e:
+                    logger.warning(f"Shard {shard.index} failed to start: {e}")
+                    delay = min(delay * 2, SHARD_RESTART_MAX_DELAY)
+                    continue
+                
+                # Трек начнётся сначала: позиция воспроизведения умерла вместе с процессом
+                streams, shard.streams = shard.streams, {}
+                results = await asyncio.gather(
+                    *(self._rejoin(shard, chat_id, stream) for chat_id, stream in streams.items()),
+                    return_exceptions=True,
+                )
+                if not shard.alive:
+                    # Упал, пока заходил в чаты — чаты не потеряны, пробуем снова
+                    logger.warning(f"Shard {shard.index} exited while rejoining, restarting")
+                    shard.streams = {**streams, **shard.streams}
+                    delay = min(delay * 2, SHARD_RESTART_MAX_DELAY)
+                    continue
+                
+                for chat_id, result in zip(streams, results):
+                    if isinstance(result, Exception):
+                        logger.warning(f"Could not rejoin {chat_id} on shard {shard.index}: {result}")
+                        self._on_lost(chat_id)
+                return
+        finally:
+            self._reviving.discard(shard.index)
+
+    async def _rejoin(self, shard: Shard, chat_id: int, stream: Optional[Tuple[str, Optional[dict]]]):
+        if stream is not None:
+            return await shard.play(chat_id, *stream)
+        
+        silent_file = self._silence()
+        try:
+            await shard.play(chat_id, silent_file, silent=True)
+        finally:
+            try:
+                os.remove(silent_file)
+            except OSError:
+                pass
+
+
+class ProgressReporter:
+    """Статус-сообщение с прогрессом. Редактируется не чаще раза в PROGRESS_INTERVAL,
+    промежуточные состояния отбрасываются, после FloodWait правки ждут.
+    Правки идут в фоне и никогда не задерживают команду"""
+
+    # Пауза после FloodWait общая для всех сообщений аккаунта
+    _flood_until: Dict[int, float] = {}
+
+    def __init__(
+        self,
+        message: Message,
+        render: Callable[[str, Optional[float]], str],
+        stats: Optional[Stats] = None,
+    ):
+        self.message = message
+        self._render = render
+        self._stats = stats
+        self._account = id(message.client)
+        self._pending: Optional[str] = None
+        self._last: Optional[str] = None
+        self._next_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._cancelled = False
+
+    def __call__(self, stage: str, fraction: Optional[float] = None):
+        if not self._closed:
+            self._push(self._render(stage, fraction))
+
+    def finish(self, text: str):
+        """Итоговый текст: будет отправлен, обновления этапов после него игнорируются.
+        Повторный finish (например, с ошибкой) заменяет предыдущий"""
+        if not self._cancelled:
+            self._push(text)
+            self._closed = True
+
+    def cancel(self):
+        """Больше не трогаем сообщение (например, перед его удалением)"""
+        self._closed = self._cancelled = True
+        self._pending = None
+        if self._task:
+            self._task.cancel()
+
+    def _push(self, text: str):
+        self._pending = text
+        if not self._task or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._pending is not None:
+            delay = max(self._next_edit, self._flood_until.get(self._account, 0)) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            # Берём только последнее состояние — всё, что пришло за паузу, отброшено
+            text, self._pending = self._pending, None
+            if text == self._last:
+                continue
+            
+            try:
+                self.message = await utils.answer(self.message, text)
+                self._last = text
+            except Exception as e:
+                if type(e).__name__ == "FloodWaitError" and getattr(e, "seconds", None):
+                    self._flood_until[self._account] = loop.time() + e.seconds
+                    if self._stats:
+                        self._stats.incr("floodwait")
+                    if self._pending is None:
+                        self._pending = text
+                    continue
+                logger.debug(f"Could not update status message: {e}")
+            
+            self._next_edit = loop.time() + PROGRESS_INTERVAL
+
+
+class Playlist:
+    """Плейлист, который разворачивается по одному треку, когда тот понадобится.
+    В очереди занимает одно место, сколько бы в нём ни было треков"""
+
+    def __init__(
+        self,
+        title: str,
+        link: str,
+        entries: Iterator[dict],
+        pool: ThreadPoolExecutor,
+        position: int = 0,
+    ):
+        self.title = title
+        self.link = link
+        # Восстановленный плейлист пропускает уже сыгранное (тоже лениво)
+        self._entries = itertools.islice(entries, position, None)
+        self._pool = pool
+        self._pulled = position
+        self._lock = asyncio.Lock()
+        self._next: Optional[dict] = None
+        self._exhausted = False
+
+    @property
+    def position(self) -> int:
+        """Сколько записей плейлиста уже отдано в очередь"""
+        return self._pulled - (self._next is not None)
+
+    async def peek(self) -> Optional[dict]:
+        """Следующий трек (без извлечения из плейлиста)"""
+        async with self._lock:
+            while self._next is None and not self._exhausted:
+                # Генератор yt-dlp может подгружать страницы плейлиста — это блокирующий код
+                entry = await asyncio.get_running_loop().run_in_executor(
+                    self._pool, next, self._entries, None
+                )
+                if entry is None:
+                    self._exhausted = True
+                    break
+                
+                self._pulled += 1
+                link = entry.get("webpage_url") or entry.get("url")
+                if link:
+                    self._next = {"link": link, "title": entry.get("title") or link}
+            
+            return self._next
+
+    async def pop(self) -> Optional[dict]:
+        """Извлекает следующий трек; None — плейлист закончился"""
+        track = await self.peek()
+        self._next = None
+        return track
+
 
 @loader.tds
 class VoiceModMod(loader.Module):
@@ -51,24 +1331,221 @@ class VoiceModMod(loader.Module):
         "recognized": "<b>🎵 [Shazam]</b> {}",
         "not_recognized": "<b>🎵 [Shazam]</b> Не удалось распознать",
         "reply_audio": "<b>🎵 [Shazam]</b> Ответь на аудио",
+        "scanning": "<b>🎵 [Shazam]</b> Сканирую запись...",
+        "scanning_progress": "<b>🎵 [Shazam]</b> Сканирую запись... {}%",
+        "tracklist": "<b>🎵 [Shazam]</b> Треклист:\n{}",
         "searching": "<b>🎵 [VoiceMod]</b> Ищу музыку...",
         "not_found": "<b>🎵 [VoiceMod]</b> Музыка <code>{}</code> не найдена",
         "no_args": "<b>🎵 [VoiceMod]</b> Укажи название",
+        "downloading_progress": "<b>🎵 [VoiceMod]</b> Скачивание... {}%",
+        "_cfg_download_workers": "Сколько загрузок и перекодирований может идти одновременно",
+        "_cfg_cache_dir": "Папка кэша медиа (пусто — ~/.cache/voicemod)",
+        "_cfg_cache_size_mb": "Максимальный размер кэша медиа в МБ",
+        "_cfg_stream_mode": "Играть ссылки потоком, без скачивания и перекодирования в MP3",
+        "_cfg_prefetch": "Сколько следующих треков очереди готовить заранее",
+        "_cfg_chat_id_ttl": "Сколько секунд хранить определённые chat_id",
+        "_cfg_lazy_init": "Запускать PyTgCalls только при первой голосовой команде",
+        "_cfg_idle_timeout": "Через сколько секунд без звонков выгружать PyTgCalls в ленивом режиме (0 — никогда)",
+        "queued": "<b>🎵 [VoiceMod]</b> Добавлено в очередь (#{})",
+        "queue": "<b>🎵 [VoiceMod]</b> Очередь:\n{}",
+        "queue_empty": "<b>🎵 [VoiceMod]</b> Очередь пуста",
+        "playlist_empty": "<b>🎵 [VoiceMod]</b> В плейлисте нет треков",
+        "volume": "<b>🎵 [VoiceMod]</b> Громкость: {}%",
+        "no_volume": "<b>🎵 [VoiceMod]</b> Укажи громкость от 0 до 200",
+        "overlay": "<b>🎵 [VoiceMod]</b> Наложено: {}",
+        "no_mixer": "<b>🎵 [VoiceMod]</b> Наложения работают на станциях и в режиме микшера (mixer в конфиге)",
+        "skipped": "<b>🎵 [VoiceMod]</b> Следующий трек!",
+        "cleared": "<b>🎵 [VoiceMod]</b> Очередь очищена!",
+        "superseded": "<b>🎵 [VoiceMod]</b> Отменено: запущен другой трек",
+        "no_station": "<b>🎵 [VoiceMod]</b> Станция <code>{}</code> не найдена",
+        "station_playing": "<b>🎵 [VoiceMod]</b> Станция <code>{}</code>: {} ({} чатов)",
+        "station_tuned": "<b>🎵 [VoiceMod]</b> Чат подключён к станции <code>{}</code>",
+        "station_untuned": "<b>🎵 [VoiceMod]</b> Чат отключён от станции",
+        "station_stopped": "<b>🎵 [VoiceMod]</b> Станция <code>{}</code> остановлена",
+        "no_station_name": "<b>🎵 [VoiceMod]</b> Укажи название станции",
+        "stats": "<b>📊 [VoiceMod]</b> Активных чатов: {}\n\n<b>Этапы</b> (p50 / p95 / p99 мс, n):\n{}\n\n<b>Счётчики</b>:\n{}",
+        "stats_empty": "—",
+        "_cfg_stats_log": "Раз в минуту писать статистику в лог в формате JSON",
+        "_cfg_download_connections": "Сколько частей файла из Telegram качать параллельно",
+        "_cfg_sm_cache_ttl": "Сколько секунд хранить результаты .sm в кэше",
+        "_cfg_sm_cache_size": "Сколько запросов .sm хранить в кэше",
+        "_cfg_normalize": "Один раз перекодировать треки в 48 кГц Opus с нормализацией громкости и играть их",
+        "_cfg_shards": "Сколько процессов-воркеров PyTgCalls запустить для звонков (0 — всё в процессе юзербота)",
+        "_cfg_mixer": "Играть очередь через встроенный микшер: громкость, кроссфейд и наложения без перезапуска потока",
+        "_cfg_crossfade": "Длина кроссфейда между треками в режиме микшера и на станциях, секунд (0 — без него)",
+        "_cfg_shazam_concurrency": "Сколько фрагментов .shazam scan распознаётся одновременно",
     }
 
     strings_ru = strings
 
     def __init__(self):
+        self.config = loader.ModuleConfig(
+            loader.ConfigValue(
+                "download_workers",
+                2,
+                lambda: self.strings("_cfg_download_workers"),
+                validator=loader.validators.Integer(minimum=1, maximum=16),
+            ),
+            loader.ConfigValue(
+                "cache_dir",
+                "",
+                lambda: self.strings("_cfg_cache_dir"),
+                validator=loader.validators.String(),
+            ),
+            loader.ConfigValue(
+                "cache_size_mb",
+                1024,
+                lambda: self.strings("_cfg_cache_size_mb"),
+                validator=loader.validators.Integer(minimum=16),
+            ),
+            loader.ConfigValue(
+                "stream_mode",
+                True,
+                lambda: self.strings("_cfg_stream_mode"),
+                validator=loader.validators.Boolean(),
+            ),
+            loader.ConfigValue(
+                "prefetch",
+                2,
+                lambda: self.strings("_cfg_prefetch"),
+                validator=loader.validators.Integer(minimum=0, maximum=5),
+            ),
+            loader.ConfigValue(
+                "chat_id_ttl",
+                86400,
+                lambda: self.strings("_cfg_chat_id_ttl"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "lazy_init",
+                False,
+                lambda: self.strings("_cfg_lazy_init"),
+                validator=loader.validators.Boolean(),
+            ),
+            loader.ConfigValue(
+                "idle_timeout",
+                900,
+                lambda: self.strings("_cfg_idle_timeout"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "stats_log",
+                False,
+                lambda: self.strings("_cfg_stats_log"),
+                validator=loader.validators.Boolean(),
+            ),
+            loader.ConfigValue(
+                "download_connections",
+                4,
+                lambda: self.strings("_cfg_download_connections"),
+                validator=loader.validators.Integer(minimum=1, maximum=16),
+            ),
+            loader.ConfigValue(
+                "sm_cache_ttl",
+                7 * 86400,
+                lambda: self.strings("_cfg_sm_cache_ttl"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "sm_cache_size",
+                500,
+                lambda: self.strings("_cfg_sm_cache_size"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "normalize",
+                True,
+                lambda: self.strings("_cfg_normalize"),
+                validator=loader.validators.Boolean(),
+            ),
+            loader.ConfigValue(
+                "shards",
+                0,
+                lambda: self.strings("_cfg_shards"),
+                validator=loader.validators.Integer(minimum=0, maximum=64),
+            ),
+            loader.ConfigValue(
+                "mixer",
+                False,
+                lambda: self.strings("_cfg_mixer"),
+                validator=loader.validators.Boolean(),
+            ),
+            loader.ConfigValue(
+                "crossfade",
+                3,
+                lambda: self.strings("_cfg_crossfade"),
+                validator=loader.validators.Integer(minimum=0, maximum=30),
+            ),
+            loader.ConfigValue(
+                "shazam_concurrency",
+                4,
+                lambda: self.strings("_cfg_shazam_concurrency"),
+                validator=loader.validators.Integer(minimum=1, maximum=16),
+            ),
+        )
         self._call_py = None
-        self._active_chats: Dict[int, bool] = {}
+        self._call_py_future: Optional[asyncio.Future] = None
+        self._call_py_handlers: list = []
+        self._last_activity = time.time()
+        # Таблица маршрутизации: chat_id -> номер воркера (LOCAL_SHARD — свой PyTgCalls)
+        self._active_chats: Dict[int, int] = {}
+        self._shards: Optional[ShardPool] = None
+        self._download_pool: Optional[ThreadPoolExecutor] = None
+        self._cache: Dict[str, dict] = {}
+        self._cache_links: Dict[str, str] = {}
+        # Ссылки, которые уже играли потоком (в порядке добавления, старые вытесняются)
+        self._streamed_links: Dict[str, None] = {}
+        self._queues: Dict[int, List[dict]] = {}
+        self._now_playing: Dict[int, dict] = {}
+        self._chat_ids: Dict[str, list] = {}
+        self._shazam_cache: Dict[str, dict] = {}
+        self._stations: Dict[str, Station] = {}
+        # Личные микшеры чатов (режим mixer) и громкость, выставленная в чатах
+        self._mixers: Dict[int, Station] = {}
+        self._volumes: Dict[int, float] = {}
+        self._stats = Stats()
+        self._sm_cache: Dict[str, dict] = {}
+        self._sm_inflight: Dict[str, asyncio.Future] = {}
+        self._scheduler = Scheduler(lambda: self.config["download_workers"])
+        self._restore_task: Optional[asyncio.Task] = None
+        self._restoring = False
+
+    async def client_ready(self, client, db):
+        self._client = client
+        self._db = db
+        self._cache = self._db.get(__name__, "cache", {})
+        self._cache_links = self._db.get(__name__, "cache_links", {})
+        self._chat_ids = self._db.get(__name__, "chat_ids", {})
+        self._shazam_cache = self._db.get(__name__, "shazam_cache", {})
+        self._sm_cache = self._db.get(__name__, "sm_cache", {})
+        
+        if not self.config["lazy_init"]:
+            self._call_py_future = asyncio.ensure_future(self._init_pytgcalls())
+        
+        # Звонки, в которых играли до перезагрузки, поднимаются сразу
+        sessions = self._db.get(__name__, "sessions", {})
+        if sessions:
+            self._restore_task = asyncio.ensure_future(self._restore_sessions(sessions))
+
+    async def _ensure_pytgcalls(self) -> bool:
+        """Поднимает PyTgCalls при первом обращении.
+        Одновременные вызовы ждут одну и ту же инициализацию"""
+        self._last_activity = time.time()
+        
+        if self._call_py_future is None:
+            self._call_py_future = asyncio.ensure_future(self._init_pytgcalls())
+        
+        await asyncio.shield(self._call_py_future)
+        return self._call_py is not None
 
-    async def client_ready(self, client, db):
-        self._client = client
-        self._db = db
+    async def _init_pytgcalls(self):
+        """Создание и запуск PyTgCalls"""
+        client = self._client
+        # Обработчики, которые pytgcalls повесит на клиент — снимем их при выгрузке
+        handlers_before = set(client.list_event_handlers())
         
         try:
             from pytgcalls import PyTgCalls
-            from pytgcalls.types import MediaStream
             
             logger.info("Initializing PyTgCalls...")
             
@@ -77,14 +1554,31 @@ class VoiceModMod(loader.Module):
             # HerokutTL имеет 'herokutl' — нужна обёртка
             wrapped_client = self._wrap_client(client)
             
-            # Также нужно создать herokutl_client.py в pytgcalls
+            # Также нужен herokutl_client в pytgcalls (собирается импорт-хуком),
             # потому что Heroku перехватывает import telethon -> herokutl
             self._patch_pytgcalls()
             
             self._call_py = PyTgCalls(wrapped_client)
+            # pytgcalls вешает обработчики в конструкторе. Сравниваем до первого await,
+            # иначе захватим обработчики, добавленные за это время другими модулями
+            self._call_py_handlers = [
+                handler for handler in client.list_event_handlers()
+                if handler not in handlers_before
+            ]
             logger.info("PyTgCalls instance created")
             
-            asyncio.create_task(self._start_pytgcalls())
+            from pytgcalls import filters as call_filters
+            from pytgcalls.types import ChatUpdate
+            self._call_py.on_update(call_filters.stream_end())(self._on_stream_end)
+            self._call_py.on_update(
+                call_filters.chat_update(ChatUpdate.Status.LEFT_CALL)
+            )(self._on_chat_left)
+            
+            await self._call_py.start()
+            logger.info("PyTgCalls started successfully")
+            
+            if self.config["shards"]:
+                await self._start_shards()
         except ImportError as e:
             logger.warning(f"pytgcalls not available: {e}")
             self._call_py = None
@@ -92,6 +1586,276 @@ class VoiceModMod(loader.Module):
             logger.exception(f"Failed to initialize PyTgCalls: {e}")
             self._call_py = None
 
+    async def _start_shards(self):
+        """Запускает воркеры; без них звонки остаются в своём PyTgCalls"""
+        try:
+            from telethon.sessions import StringSession
+            
+            # Воркеры подключаются под той же авторизацией, что и юзербот
+            init = {
+                "session": StringSession.save(self._client.session),
+                "api_id": self._client.api_id,
+                "api_hash": self._client.api_hash,
+            }
+            pool = ShardPool(
+                self.config["shards"],
+                self._shard_script(),
+                init,
+                self._stream_ended,
+                self._chat_lost,
+                self._create_silent_wav,
+            )
+            await pool.start()
+            self._shards = pool
+            logger.info(f"Started {len(pool)} PyTgCalls shards")
+        except Exception as e:
+            logger.exception(f"Could not start shards, using in-process PyTgCalls: {e}")
+
+    def _shard_script(self) -> str:
+        """Пишет скрипт воркера в кэш (один раз на версию исходника)"""
+        digest = hashlib.sha256(SHARD_WORKER_SOURCE.encode()).hexdigest()[:16]
+        path = os.path.join(self._cache_root(), "code", f"shard_worker-{digest}.py")
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.part", "w") as f:
+                f.write(SHARD_WORKER_SOURCE)
+            os.replace(f"{path}.part", path)
+        
+        return path
+
+    def _calls(self, chat_id: int):
+        """PyTgCalls или воркер, который обслуживает чат"""
+        index = self._active_chats.get(chat_id, LOCAL_SHARD)
+        if index == LOCAL_SHARD or not self._shards:
+            return self._call_py
+        return self._shards[index]
+
+    async def _move_chat(self, chat_id: int, index: int):
+        """Выходит из звонка на прежнем воркере, если чат переезжает"""
+        current = self._active_chats.get(chat_id)
+        if current is None or current == index:
+            return
+        
+        try:
+            await self._calls(chat_id).leave_call(chat_id)
+        except Exception as e:
+            logger.debug(f"Could not leave {chat_id} before moving it: {e}")
+        self._active_chats.pop(chat_id, None)
+
+    async def _start_stream(
+        self,
+        chat_id: int,
+        source: str,
+        headers: Optional[dict] = None,
+        offset: float = 0,
+        silent: bool = False,
+    ):
+        """Запускает файл или поток в звонке на воркере, за которым закреплён чат.
+        silent — источник временный файл с тишиной, его нельзя запоминать для перезапуска"""
+        index = self._shards.index_for(chat_id) if self._shards else LOCAL_SHARD
+        await self._move_chat(chat_id, index)
+        
+        if index == LOCAL_SHARD:
+            with self._stats.timer("media_stream"):
+                stream = self._media_stream(source, headers, offset)
+            with self._stats.timer("call.play"):
+                await self._call_py.play(chat_id, stream)
+        else:
+            peer = await self._shard_peer(chat_id)
+            with self._stats.timer("call.play"):
+                await self._shards[index].play(chat_id, source, headers, offset, peer, silent)
+        
+        self._active_chats[chat_id] = index
+
+    async def _shard_peer(self, chat_id: int) -> Optional[dict]:
+        """Input peer чата из кэша основного клиента — у сессии воркера его нет"""
+        try:
+            peer = (await self._client.get_input_entity(chat_id)).to_dict()
+        except Exception as e:
+            logger.debug(f"Could not resolve {chat_id} for shard: {e}")
+            return None
+        return {"type": peer.pop("_"), "fields": peer}
+
+    async def _on_chat_left(self, _, update):
+        """Звонок закрыли или аккаунт выгнали из чата.
+        Воркеры апдейтов не получают — об этом им сообщает основной PyTgCalls"""
+        chat_id = update.chat_id
+        index = self._active_chats.get(chat_id)
+        if index is None or index == LOCAL_SHARD or not self._shards:
+            return
+        
+        logger.info(f"Left call in {chat_id} on shard {index}: {update.status}")
+        try:
+            await self._shards[index].leave_call(chat_id)
+        except Exception as e:
+            logger.debug(f"Shard {index} could not leave {chat_id}: {e}")
+        self._chat_lost(chat_id)
+
+    def _chat_lost(self, chat_id: int):
+        """Воркер не смог вернуться в чат после перезапуска"""
+        self._active_chats.pop(chat_id, None)
+        self._clear_queue(chat_id)
+        self._now_playing.pop(chat_id, None)
+        self._save_sessions()
+
+    @staticmethod
+    def _position(track: dict) -> float:
+        """Сколько секунд трека уже сыграно"""
+        if "started" not in track:
+            return 0
+        now = track.get("paused") or time.time()
+        return max(0.0, track.get("offset", 0) + now - track["started"])
+
+    @staticmethod
+    def _serialize_track(track: dict) -> Optional[dict]:
+        """Элемент очереди в виде, пригодном для БД"""
+        if track.get("playlist"):
+            playlist = track["playlist"]
+            return {"title": track["title"], "playlist": playlist.link, "position": playlist.position}
+        if track.get("message"):
+            message = track["message"]
+            return {"title": track["title"], "chat": message.chat_id, "msg_id": message.id}
+        if track.get("link"):
+            return {"title": track["title"], "link": track["link"]}
+        return None
+
+    async def _deserialize_track(self, data: dict) -> Optional[dict]:
+        if data.get("playlist"):
+            track = await self._probe_track(
+                {"link": data["playlist"], "title": data["title"]}, data.get("position", 0)
+            )
+            return track if track.get("playlist") else None
+        if data.get("msg_id"):
+            message = await self._client.get_messages(data["chat"], ids=data["msg_id"])
+            return self._make_track(None, message) if message and message.file else None
+        return {"link": data["link"], "title": data["title"]}
+
+    def _save_sessions(self):
+        """Сохраняет звонки: трек, позицию в нём и очередь. Станции не сохраняются"""
+        if self._restoring:
+            # Иначе ещё не восстановленные чаты пропали бы из БД
+            return
+        
+        on_stations = set().union(*(station.chats for station in self._stations.values()))
+        sessions = {}
+        for chat_id in self._active_chats:
+            if chat_id in on_stations:
+                continue
+            
+            track = self._now_playing.get(chat_id)
+            sessions[str(chat_id)] = {
+                "track": track and self._serialize_track(track),
+                "source": track and track.get("source"),
+                "offset": track and self._position(track),
+                "paused": bool(track and track.get("paused")),
+                "queue": [
+                    data for data in map(self._serialize_track, self._queues.get(chat_id, []))
+                    if data
+                ],
+            }
+        
+        self._db.set(__name__, "sessions", sessions)
+
+    async def _restore_sessions(self, sessions: Dict[str, dict]):
+        """Возвращается во все сохранённые звонки параллельно"""
+        if not await self._ensure_pytgcalls():
+            return
+        
+        self._restoring = True
+        try:
+            with self._stats.timer("restore"):
+                results = await asyncio.gather(
+                    *(self._restore_chat(int(chat_id), state) for chat_id, state in sessions.items()),
+                    return_exceptions=True,
+                )
+        finally:
+            self._restoring = False
+        
+        for chat_id, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not restore voice chat {chat_id}: {result}")
+                self._stats.record_error(result)
+        
+        self._save_sessions()
+
+    async def _restore_chat(self, chat_id: int, state: dict):
+        track = state.get("track") and await self._deserialize_track(state["track"])
+        if not track:
+            await self._join_silent(chat_id)
+        else:
+            source = state.get("source")
+            if source and os.path.isfile(source):
+                # Файл уже в кэше — ни извлечения, ни загрузки
+                ready = asyncio.get_running_loop().create_future()
+                ready.set_result((source, None))
+                track["task"] = ready
+            
+            await self._play_track(chat_id, track, owner=(chat_id, "queue"), offset=state.get("offset") or 0)
+            if state.get("paused"):
+                await self._set_paused(chat_id, True)
+        
+        # Очередь — уже после того, как звук пошёл
+        queue = await asyncio.gather(
+            *(self._deserialize_track(data) for data in state.get("queue", [])),
+            return_exceptions=True,
+        )
+        queue = [item for item in queue if isinstance(item, dict)]
+        if queue:
+            self._queues.setdefault(chat_id, []).extend(queue)
+            self._prefetch(chat_id)
+            if not track:
+                await self._play_next(chat_id)
+
+    @loader.loop(interval=30, autostart=True)
+    async def _session_saver(self):
+        """Обновляет позиции воспроизведения на случай падения юзербота"""
+        if self._active_chats:
+            self._save_sessions()
+
+    async def _shutdown_pytgcalls(self):
+        """Останавливает PyTgCalls; следующая команда запустит его заново"""
+        # Выгрузка может прийти посреди запуска — он не должен закончиться после неё
+        future, self._call_py_future = self._call_py_future, None
+        if future and not future.done():
+            future.cancel()
+        call_py, self._call_py = self._call_py, None
+        
+        if self._shards:
+            await self._shards.stop()
+            self._shards = None
+        
+        for name in ("stop", "close"):
+            method = getattr(call_py, name, None)
+            if method:
+                try:
+                    result = method()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    logger.debug(f"PyTgCalls.{name} failed: {e}")
+                break
+        
+        # Иначе новый экземпляр получил бы апдейты дважды
+        for callback, event in self._call_py_handlers:
+            self._client.remove_event_handler(callback, event)
+        self._call_py_handlers = []
+        
+        if call_py:
+            logger.info("PyTgCalls stopped")
+
+    @loader.loop(interval=60, autostart=True)
+    async def _idle_watchdog(self):
+        """Выгружает PyTgCalls в ленивом режиме, если звонков давно нет"""
+        timeout = self.config["idle_timeout"]
+        if (
+            self.config["lazy_init"]
+            and timeout
+            and self._call_py is not None
+            and not self._active_chats
+            and time.time() - self._last_activity > timeout
+        ):
+            await self._shutdown_pytgcalls()
+
     def _wrap_client(self, client):
         """Обёртка чтобы pytgcalls видел herokutl как telethon"""
         class TelethonClientWrapper:
@@ -111,92 +1875,63 @@ class VoiceModMod(loader.Module):
         return TelethonClientWrapper(client)
 
     def _patch_pytgcalls(self):
-        """Создаёт и патчит herokutl_client.py для совместимости с herokutl"""
-        import shutil
-        
+        """Подключает импорт-хук, собирающий herokutl_client в памяти.
+        В site-packages ничего не пишется"""
         try:
             import pytgcalls
-            pytgcalls_path = os.path.dirname(pytgcalls.__file__)
-            mtproto_path = os.path.join(pytgcalls_path, "mtproto")
-            
-            src = os.path.join(mtproto_path, "telethon_client.py")
-            dst = os.path.join(mtproto_path, "herokutl_client.py")
-            pycache = os.path.join(mtproto_path, "__pycache__")
-            
-            # Всегда удаляем старый herokutl_client и кэш для чистого патча
-            if os.path.exists(dst):
-                os.remove(dst)
-                logger.info("Removed old herokutl_client.py")
-            if os.path.exists(pycache):
-                shutil.rmtree(pycache)
-                logger.info("Removed __pycache__")
-            
-            if os.path.exists(src):
-                # Читаем telethon_client.py
-                with open(src, 'r') as f:
-                    content = f.read()
-                
-                # Заменяем telethon на herokutl
-                content = content.replace('from telethon', 'from herokutl')
-                content = content.replace('import telethon', 'import herokutl')
-                
-                # ГЛАВНЫЙ ПАТЧ: полностью переписываем обработку UpdateGroupCall
-                # herokutl имеет peer вместо chat_id
-                # Отступы: 12 пробелов для основного блока, 16 для вложенного
-                old_block = """            if isinstance(
-                update,
-                UpdateGroupCall,
-            ):
-                chat_id = self.chat_id(
-                    await self._get_entity_group(
-                        update.chat_id,
-                    ),
-                )"""
-                
-                new_block = """            if isinstance(
-                update,
-                UpdateGroupCall,
-            ):
-                # herokutl compatibility patch
-                try:
-                    if hasattr(update, 'peer') and update.peer:
-                        if hasattr(update.peer, 'channel_id'):
-                            raw_id = update.peer.channel_id
-                        elif hasattr(update.peer, 'chat_id'):
-                            raw_id = update.peer.chat_id
-                        else:
-                            return
-                    elif hasattr(update, 'chat_id'):
-                        raw_id = update.chat_id
-                    else:
-                        return
-                    chat_id = self.chat_id(
-                        await self._get_entity_group(raw_id),
-                    )
-                except Exception:
-                    return"""
-                
-                content = content.replace(old_block, new_block)
-                
-                # Записываем
-                with open(dst, 'w') as f:
-                    f.write(content)
-                
-                logger.info(f"Created/updated herokutl_client.py with patches")
+            src = os.path.join(
+                os.path.dirname(pytgcalls.__file__), "mtproto", "telethon_client.py"
+            )
+            
+            if not os.path.exists(src):
+                logger.warning("telethon_client.py not found, pytgcalls left unpatched")
+                return
+            
+            # Убираем хук, оставшийся от прошлой загрузки модуля
+            sys.meta_path[:] = [
+                finder for finder in sys.meta_path
+                if not getattr(finder, "voicemod_patch", False)
+            ]
+            sys.meta_path.insert(
+                0, HerokutlClientFinder(src, os.path.join(self._cache_root(), "code"))
+            )
+            logger.info("Installed in-memory herokutl_client import hook")
         except Exception as e:
             logger.warning(f"Could not patch pytgcalls: {e}")
 
-    async def _start_pytgcalls(self):
-        """Запуск PyTgCalls в фоне"""
-        try:
-            await self._call_py.start()
-            logger.info("PyTgCalls started successfully")
-        except Exception as e:
-            logger.exception(f"Failed to start PyTgCalls: {e}")
+    async def _get_chat_id(self, message: Message, args: Optional[str] = None) -> Optional[int]:
+        """Получить ID чата из аргументов или текущего чата (с кэшем)"""
+        if args is None:
+            args = utils.get_args_raw(message)
+        key = args.split()[0] if args else f"peer:{utils.get_chat_id(message)}"
+        
+        cached = self._chat_ids.get(key)
+        if cached and time.time() - cached[1] < self.config["chat_id_ttl"]:
+            self._stats.incr("chat_id.cache_hit")
+            return cached[0]
+        
+        with self._stats.timer("chat_id.resolve"):
+            chat_id = await self._resolve_chat_id(message, args)
+        if chat_id:
+            self._chat_ids[key] = [chat_id, time.time()]
+            self._db.set(__name__, "chat_ids", self._chat_ids)
+        
+        return chat_id
 
-    async def _get_chat_id(self, message: Message) -> Optional[int]:
-        """Получить ID чата из аргументов или текущего чата"""
-        args = utils.get_args_raw(message)
+    def _invalidate_chat_id(self, chat_id: int, error: Exception):
+        """Сбрасывает кэш chat_id, если звонок упал из-за ошибки пира"""
+        if type(error).__name__ not in PEER_ERRORS:
+            return
+        
+        for key, (cached_id, _) in list(self._chat_ids.items()):
+            if cached_id == chat_id:
+                self._chat_ids.pop(key, None)
+        
+        self._db.set(__name__, "chat_ids", self._chat_ids)
+
+    async def _resolve_chat_id(self, message: Message, args: str) -> Optional[int]:
+        """Определяет ID группового звонка"""
+        entity = None
         
         if args:
             try:
@@ -210,13 +1945,19 @@ class VoiceModMod(loader.Module):
                     return None
         else:
             chat_id = utils.get_chat_id(message)
+            # Тип текущего чата известен из peer_id — запрос не нужен
+            if isinstance(message.peer_id, PeerChannel):
+                return int(f"-100{chat_id}")
+            if isinstance(message.peer_id, PeerChat):
+                return -chat_id
         
         # pytgcalls проверяет: is_p2p = chat_id > 0
         # Для group calls нужен ОТРИЦАТЕЛЬНЫЙ chat_id
         # Формат: -100XXXXXXXXXX для каналов/супергрупп
         if chat_id and chat_id > 0:
             try:
-                entity = await message.client.get_entity(message.peer_id)
+                if entity is None:
+                    entity = await message.client.get_entity(message.peer_id)
                 # Канал или супергруппа
                 if hasattr(entity, 'broadcast') or hasattr(entity, 'megagroup'):
                     chat_id = int(f"-100{chat_id}")
@@ -227,12 +1968,752 @@ class VoiceModMod(loader.Module):
                 # Если не получилось определить тип, пробуем как супергруппу
                 chat_id = int(f"-100{chat_id}")
         
-        logger.info(f"Resolved chat_id: {chat_id}")
-        return chat_id
+        logger.info(f"Resolved chat_id: {chat_id}")
+        return chat_id
+
+    def _get_download_pool(self) -> ThreadPoolExecutor:
+        """Пул потоков для yt-dlp, создаётся при первой загрузке"""
+        if self._download_pool is None:
+            self._download_pool = ThreadPoolExecutor(
+                max_workers=self.config["download_workers"],
+                thread_name_prefix="voicemod-dl",
+            )
+        return self._download_pool
+
+    async def _run_blocking(self, func: Callable, *args):
+        """Выполняет блокирующий код (yt-dlp) в пуле загрузок.
+        Отменённый вызов ждёт, пока поток действительно закончит (yt-dlp прерывается
+        на ближайшем хуке по cancel_event): иначе поток продолжал бы занимать пул
+        и писать в те же файлы, что и задача, запущенная вместо него"""
+        future = self._get_download_pool().submit(func, *args)
+        wrapped = asyncio.wrap_future(future)
+        try:
+            return await asyncio.shield(wrapped)
+        except asyncio.CancelledError:
+            # Ещё не начатый вызов просто снимается с очереди пула
+            future.cancel()
+            await asyncio.wait([wrapped])
+            if not wrapped.cancelled():
+                wrapped.exception()
+            raise
+
+    def _cache_root(self) -> str:
+        """Папка кэша медиа"""
+        root = self.config["cache_dir"] or os.path.join(
+            os.path.expanduser("~"), ".cache", "voicemod"
+        )
+        os.makedirs(root, exist_ok=True)
+        return root
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Путь к закэшированному файлу или None"""
+        entry = self._cache.get(key)
+        if not entry:
+            self._stats.incr("cache.miss")
+            return None
+
+        if not os.path.exists(entry["path"]):
+            self._cache.pop(key, None)
+            self._db.set(__name__, "cache", self._cache)
+            self._stats.incr("cache.miss")
+            return None
+
+        self._stats.incr("cache.hit")
+        entry["atime"] = time.time()
+        self._db.set(__name__, "cache", self._cache)
+        return entry["path"]
+
+    def _cache_put(self, key: str, path: str):
+        """Регистрирует файл в кэше и вытесняет старые записи"""
+        size = os.path.getsize(path)
+        if size > self.config["cache_size_mb"] * 1024 * 1024:
+            # Больше всей квоты — вытеснил бы сам себя. Играет без кэша, файл потом уберёт janitor
+            logger.debug(f"{key} is larger than the cache quota, not caching")
+            return
+        
+        self._cache[key] = {
+            "path": os.path.abspath(path),
+            "size": size,
+            "atime": time.time(),
+        }
+        self._cache_evict(keep=key)
+        self._db.set(__name__, "cache", self._cache)
+
+    def _playing_paths(self) -> Set[str]:
+        """Локальные файлы, которые сейчас играют — их нельзя удалять"""
+        return {
+            os.path.abspath(track["source"])
+            for track in self._now_playing.values()
+            if track.get("source")
+        }
+
+    def _cache_evict(self, keep: Optional[str] = None):
+        """Удаляет давно не использованные файлы, пока кэш больше квоты.
+        Только что добавленная запись и играющие файлы не трогаются"""
+        quota = self.config["cache_size_mb"] * 1024 * 1024
+        total = sum(entry["size"] for entry in self._cache.values())
+        playing = self._playing_paths()
+
+        for key, entry in sorted(self._cache.items(), key=lambda x: x[1]["atime"]):
+            if total <= quota:
+                break
+            if key == keep or entry["path"] in playing:
+                continue
+
+            total -= entry["size"]
+            self._cache.pop(key, None)
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+            logger.debug(f"Evicted {key} from cache")
+
+    @loader.loop(interval=600, autostart=True)
+    async def _cache_janitor(self):
+        """Фоновая чистка кэша: потерянные записи, сиротские файлы, квота"""
+        if not hasattr(self, "_db"):
+            return
+
+        for key, entry in list(self._cache.items()):
+            if not os.path.exists(entry["path"]):
+                self._cache.pop(key, None)
+
+        # Файлы без записи в индексе (прерванные загрузки и т.п.).
+        # Свежие не трогаем — они могут ещё скачиваться
+        known = {entry["path"] for entry in self._cache.values()} | self._playing_paths()
+        # Пути в индексе абсолютные — иначе при относительном cache_dir сиротами выглядели бы все
+        root = os.path.abspath(self._cache_root())
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                if path not in known and time.time() - os.path.getmtime(path) > 3600:
+                    os.remove(path)
+            except OSError:
+                pass
+
+        self._cache_evict()
+        self._db.set(__name__, "cache", self._cache)
+
+        for link, key in list(self._cache_links.items()):
+            if key not in self._cache:
+                self._cache_links.pop(link, None)
+        self._db.set(__name__, "cache_links", self._cache_links)
+
+        ttl = self.config["chat_id_ttl"]
+        for key, (_, resolved_at) in list(self._chat_ids.items()):
+            if time.time() - resolved_at >= ttl:
+                self._chat_ids.pop(key, None)
+        self._db.set(__name__, "chat_ids", self._chat_ids)
+
+    async def _download_file(
+        self,
+        msg: Message,
+        path: str,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        on_start: Optional[Callable[[ChunkedDownload], None]] = None,
+    ) -> str:
+        """Скачивает документ; большие файлы — параллельными частями"""
+        size = msg.file.size or 0
+        
+        def progress_callback(current: int, total: int):
+            if progress and total:
+                progress("downloading", current / total)
+        
+        try:
+            if size < PARALLEL_DOWNLOAD_MIN_SIZE:
+                return await msg.download_media(file=path, progress_callback=progress_callback)
+            
+            download = ChunkedDownload(
+                self._client,
+                msg.document,
+                size,
+                path,
+                self.config["download_connections"],
+                progress,
+            )
+            if on_start:
+                on_start(download)
+            
+            return await download.run()
+        except BaseException:
+            # Недокачанный файл (в том числе при отмене) не оставляем
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise
+
+    async def _download_telegram(
+        self,
+        msg: Message,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        on_start: Optional[Callable[[ChunkedDownload], None]] = None,
+    ) -> str:
+        """Скачивает аудио из Telegram в кэш (ключ — id документа и access_hash).
+        on_start получает загрузку, если она идёт частями, — её начало можно играть сразу"""
+        doc = msg.document
+        key = f"tg:{doc.id}:{doc.access_hash}"
+
+        path = self._cache_get(key)
+        if path:
+            return self._prefer_normalized(key, path)
+
+        with self._stats.timer("tg.download"):
+            path = await self._download_file(
+                msg,
+                os.path.join(self._cache_root(), f"tg-{doc.id}{msg.file.ext or ''}"),
+                progress,
+                on_start,
+            )
+        self._stats.incr("bytes.downloaded", os.path.getsize(path))
+        self._cache_put(key, path)
+        return self._prefer_normalized(key, path)
+
+    async def _ytdl_download(
+        self,
+        link: str,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        cancel: Optional[threading.Event] = None,
+        info: Optional[dict] = None,
+    ) -> str:
+        """Скачивает и конвертирует трек в пуле потоков, не блокируя event loop.
+        Результат кэшируется по extractor и id из yt-dlp.
+        info — уже извлечённые (без обработки) данные трека, если есть"""
+        import yt_dlp
+        from yt_dlp.utils import DownloadCancelled
+
+        loop = asyncio.get_running_loop()
+
+        def report(stage: str, fraction: Optional[float] = None):
+            # Хуки yt-dlp вызываются из рабочего потока
+            if progress:
+                loop.call_soon_threadsafe(progress, stage, fraction)
+
+        def download_hook(d: dict):
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled("superseded")
+            if d.get("status") == "finished":
+                loop.call_soon_threadsafe(
+                    self._stats.incr, "bytes.downloaded", d.get("downloaded_bytes") or 0
+                )
+            if d.get("status") != "downloading":
+                return
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if total:
+                report("downloading", d.get("downloaded_bytes", 0) / total)
+
+        postprocess_started = {}
+
+        def postprocessor_hook(d: dict):
+            if d.get("status") == "started":
+                postprocess_started[d.get("postprocessor")] = time.perf_counter()
+                report("converting")
+            elif d.get("status") == "finished" and d.get("postprocessor") in postprocess_started:
+                elapsed = time.perf_counter() - postprocess_started.pop(d.get("postprocessor"))
+                loop.call_soon_threadsafe(self._stats.observe, "ytdl.postprocess", elapsed)
+
+        ydl_opts = {
+            "format": "bestaudio/best",
+            "outtmpl": os.path.join(self._cache_root(), "%(extractor_key)s-%(id)s.%(ext)s"),
+            "quiet": True,
+            "no_warnings": True,
+            # Плейлисты разворачиваются выше, здесь — только один трек
+            "noplaylist": True,
+            "progress_hooks": [download_hook],
+            "postprocessor_hooks": [postprocessor_hook],
+            # С нормализацией в MP3 не конвертируем: трек всё равно перекодируется в Opus
+            "postprocessors": [] if self.config["normalize"] else [{
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": "320",
+            }],
+        }
+
+        def extract() -> dict:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                return ydl.extract_info(link, download=False)
+
+        def download(info: dict) -> str:
+            try:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    info = ydl.process_ie_result(info, download=True)
+                    downloads = info.get("requested_downloads")
+                    if downloads and downloads[0].get("filepath"):
+                        return downloads[0]["filepath"]
+                    if ydl_opts["postprocessors"]:
+                        return os.path.splitext(ydl.prepare_filename(info))[0] + ".mp3"
+                    return ydl.prepare_filename(info)
+            except BaseException:
+                # Убираем недокачанные части (.part, .ytdl, фрагменты)
+                prefix = os.path.join(self._cache_root(), f"{info['extractor_key']}-{info['id']}.")
+                for partial in glob.glob(glob.escape(prefix) + "*"):
+                    if ".part" in partial or partial.endswith((".ytdl", ".temp")):
+                        try:
+                            os.remove(partial)
+                        except OSError:
+                            pass
+                raise
+
+        # Повторная ссылка — сразу из кэша, без обращения к экстрактору
+        key = self._cache_links.get(link)
+        path = key and self._cache_get(key)
+        if path:
+            return self._prefer_normalized(key, path)
+
+        if info is None:
+            with self._stats.timer("ytdl.extract"):
+                info = await self._run_blocking(extract)
+        else:
+            # Данные могут быть общими для нескольких команд — обрабатываем копию
+            info = dict(info)
+
+        key = f"yt:{info['extractor_key']}:{info['id']}"
+        self._cache_links[link] = key
+        self._db.set(__name__, "cache_links", self._cache_links)
+
+        path = self._cache_get(key)
+        if path:
+            return self._prefer_normalized(key, path)
+
+        with self._stats.timer("ytdl.download"):
+            path = await self._run_blocking(download, info)
+        self._cache_put(key, path)
+        return self._prefer_normalized(key, path)
+
+    async def _ytdl_stream(self, link: str, info: Optional[dict] = None) -> Tuple[str, Optional[dict]]:
+        """Прямая ссылка на аудиодорожку без скачивания.
+        Предпочитаем Opus/WebM — их не нужно перекодировать"""
+        import yt_dlp
+
+        ydl_opts = {
+            "format": "bestaudio[acodec=opus]/bestaudio[ext=webm]/bestaudio/best",
+            "quiet": True,
+            "no_warnings": True,
+            "noplaylist": True,
+        }
+
+        def extract() -> dict:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                if info is not None:
+                    return ydl.process_ie_result(dict(info), download=False)
+                return ydl.extract_info(link, download=False)
+
+        with self._stats.timer("ytdl.resolve"):
+            info = await self._run_blocking(extract)
+        return info["url"], info.get("http_headers")
+
+    async def _ytdl_probe(self, link: str) -> dict:
+        """Извлекает ссылку без обработки форматов. У плейлиста entries — ленивый
+        генератор плоских записей: страницы и треки не запрашиваются заранее"""
+        import yt_dlp
+
+        ydl_opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "extract_flat": "in_playlist",
+            "lazy_playlist": True,
+        }
+
+        def extract() -> dict:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                return ydl.extract_info(link, download=False, process=False)
+
+        with self._stats.timer("ytdl.probe"):
+            return await self._run_blocking(extract)
+
+    async def _probe_track(self, track: dict, position: int = 0) -> dict:
+        """Ссылку на плейлист превращает в элемент очереди с ленивым плейлистом.
+        Для обычного трека данные экстрактора сохраняются, чтобы не извлекать их повторно"""
+        link = track.get("link")
+        if not link or self._cache_links.get(link):
+            return track
+        
+        # Одинаковые ссылки из нескольких команд извлекаются один раз
+        info = await self._scheduler.submit(
+            f"probe:{link}", lambda cancel: self._ytdl_probe(link), Scheduler.FOREGROUND
+        )
+        if info.get("_type") in PLAYLIST_TYPES:
+            title = info.get("title") or link
+            entries = info.pop("entries", None)
+            if entries is None:
+                # Генератор уже забрала другая команда — у каждой очереди свой
+                entries = (await self._ytdl_probe(link)).get("entries")
+            entries = iter(entries or ())
+            return {
+                "playlist": Playlist(title, link, entries, self._get_download_pool(), position),
+                "title": title,
+            }
+        
+        if info.get("_type", "video") == "video":
+            track["info"] = info
+        return track
+
+    async def _resolve_source(
+        self,
+        link: str,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        cancel: Optional[threading.Event] = None,
+        info: Optional[dict] = None,
+    ) -> Tuple[str, Optional[dict]]:
+        """Источник для MediaStream: файл из кэша, поток или скачанный файл"""
+        key = self._cache_links.get(link)
+        path = key and self._cache_get(key)
+        if path:
+            return self._prefer_normalized(key, path), None
+
+        if self.config["stream_mode"]:
+            source = await self._ytdl_stream(link, info)
+            if self.config["normalize"] and link in self._streamed_links:
+                # Ссылку играют повторно — готовим локальную копию к следующему разу.
+                # Разовое прослушивание не стоит полной загрузки и перекодирования.
+                # Ставим после получения потока, чтобы не занимать пул раньше него
+                self._scheduler.submit(
+                    f"download:{link}",
+                    lambda cancel: self._ytdl_download(link, cancel=cancel),
+                    Scheduler.BACKGROUND,
+                )
+            self._streamed_links.pop(link, None)
+            self._streamed_links[link] = None
+            if len(self._streamed_links) > STREAMED_LINKS_SIZE:
+                self._streamed_links.pop(next(iter(self._streamed_links)))
+            return source
+
+        return await self._ytdl_download(link, progress, cancel, info), None
+
+    def _prefer_normalized(self, key: str, path: str) -> str:
+        """Нормализованная версия трека, если она уже готова; иначе готовит её в фоне"""
+        if not self.config["normalize"] or key.endswith(":opus"):
+            return path
+        
+        normalized = self._cache_get(f"{key}:opus")
+        if normalized:
+            return normalized
+        
+        self._scheduler.submit(
+            f"normalize:{key}",
+            lambda cancel: self._normalize(key, path),
+            Scheduler.BACKGROUND,
+        )
+        return path
+
+    async def _normalize(self, key: str, path: str):
+        """Перекодирует трек в формат, который pytgcalls отдаёт в звонок без ресемплинга"""
+        dst = f"{os.path.splitext(path)[0]}.norm.opus"
+        tmp = f"{dst}.part"
+        
+        with self._stats.timer("normalize"):
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-v", "quiet", "-y",
+                "-i", path,
+                "-vn", "-af", LOUDNORM_FILTER,
+                "-ar", str(PCM_SAMPLE_RATE), "-ac", str(PCM_CHANNELS),
+                "-c:a", "libopus", "-b:a", NORMALIZED_BITRATE,
+                "-f", "ogg", tmp,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            try:
+                returncode = await proc.wait()
+            except asyncio.CancelledError:
+                proc.kill()
+                returncode = None
+                raise
+            finally:
+                if returncode != 0:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+            
+            if returncode:
+                raise RuntimeError(f"ffmpeg exited with {returncode}")
+        
+        os.replace(tmp, dst)
+        self._cache_put(f"{key}:opus", dst)
+
+    def _media_stream(self, source: str, headers: Optional[dict] = None, offset: float = 0):
+        """MediaStream только со звуком: видеодорожка не декодируется.
+        offset — с какой секунды начать (при восстановлении сессии)"""
+        from pytgcalls.types import MediaStream
+
+        return MediaStream(
+            source,
+            video_flags=MediaStream.Flags.IGNORE,
+            headers=headers,
+            ffmpeg_parameters=f"-ss {offset:.1f}" if offset else None,
+        )
+
+    def _parse_play_args(self, message: Message, reply) -> Tuple[Optional[str], Optional[Message]]:
+        """Ссылка из аргументов или реплай на аудио"""
+        args = utils.get_args_raw(message)
+        link = None
+        
+        if args:
+            match = re.match(r"(-?\d+|@[\w]{5,})\s+(.*)", args)
+            if match:
+                # Первый аргумент — chat_id, остальное — ссылка
+                link = match.group(2)
+            else:
+                link = args
+        
+        if reply and reply.audio and not link:
+            return None, reply
+        
+        return link, None
+
+    def _make_track(self, link: Optional[str], audio_file: Optional[Message]) -> dict:
+        """Элемент очереди"""
+        if audio_file:
+            title = audio_file.file.title or audio_file.file.name or "audio"
+            return {"message": audio_file, "title": title}
+        
+        return {"link": link, "title": link}
+
+    async def _resolve_track(
+        self,
+        track: dict,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> Tuple[str, Optional[dict]]:
+        """Источник для трека очереди"""
+        if track.get("message"):
+            download = track.get("download")
+            on_start = None
+            if download is not None:
+                on_start = lambda chunked: download.done() or download.set_result(chunked)
+            return await self._download_telegram(track["message"], progress, on_start), None
+        
+        return await self._resolve_source(track["link"], progress, cancel, track.pop("info", None))
+
+    def _track_key(self, track: dict) -> str:
+        """Ключ для склейки одинаковых задач в планировщике"""
+        if track.get("message"):
+            doc = track["message"].document
+            return f"tg:{doc.id}:{doc.access_hash}"
+        
+        return f"link:{track['link']}"
+
+    def _prepare_track(
+        self,
+        track: dict,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        priority: int = Scheduler.FOREGROUND,
+        owner: Any = None,
+    ) -> asyncio.Future:
+        """Ставит подготовку трека в планировщик; повторный вызов может поднять приоритет"""
+        task = track.get("task")
+        if task is None or task.cancelled() or not task.done():
+            if track.get("message"):
+                # Сюда придёт загрузка частями, если файл большой: микшер играет её начало
+                track["download"] = asyncio.get_running_loop().create_future()
+            track["task"] = self._scheduler.submit(
+                self._track_key(track),
+                lambda cancel: self._resolve_track(track, progress, cancel),
+                priority,
+                owner,
+            )
+        
+        return track["task"]
+
+    def _prefetch(self, chat_id: int):
+        """Готовит следующие треки очереди, пока играет текущий"""
+        for track in self._queues.get(chat_id, [])[: self.config["prefetch"]]:
+            if track.get("playlist"):
+                # Из плейлиста — только ближайший трек
+                task = asyncio.ensure_future(self._prefetch_playlist(chat_id, track["playlist"]))
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                continue
+            self._prepare_track(track, priority=Scheduler.PREFETCH, owner=(chat_id, "queue"))
+
+    async def _prefetch_playlist(self, chat_id: int, playlist: Playlist):
+        track = await playlist.peek()
+        if track:
+            self._prepare_track(track, priority=Scheduler.PREFETCH, owner=(chat_id, "queue"))
+
+    def _clear_queue(self, chat_id: int):
+        """Очищает очередь и отменяет подготовку треков"""
+        self._queues.pop(chat_id, None)
+        self._scheduler.cancel((chat_id, "queue"))
+
+    async def _play_track(
+        self,
+        chat_id: int,
+        track: dict,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+        owner: Any = None,
+        offset: float = 0,
+    ):
+        """Дожидается подготовки трека и запускает его в звонке"""
+        task = self._prepare_track(track, progress, owner=owner)
+        feed = None
+        download = track.get("download")
+        if self.config["mixer"] and download is not None and not offset and not task.done():
+            # Микшер читает из потока: большой файл из Telegram играет,
+            # как только докачается его начало. PyTgCalls нужен готовый файл
+            await asyncio.wait([task, download], return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                feed = download.result().iter_ready()
+        
+        source, headers = (None, None) if feed else await task
+        self._detach_station(chat_id, keep_mixer=self.config["mixer"])
+        if self.config["mixer"]:
+            await self._mix_play(chat_id, track["title"], source, headers, offset, feed)
+        else:
+            await self._start_stream(chat_id, source, headers, offset)
+        
+        # Позиция воспроизведения и локальный файл — для восстановления сессии
+        track["offset"] = offset
+        track["started"] = time.time()
+        track["source"] = source if source and not headers and os.path.isfile(source) else None
+        self._now_playing[chat_id] = track
+        self._prefetch(chat_id)
+        self._save_sessions()
+
+    async def _play_next(self, chat_id: int, finished: bool = True) -> bool:
+        """Следующий трек очереди; битые треки пропускаются.
+        finished=False — текущий трек ещё играет (.vskip): если играть нечего, он остаётся"""
+        queue = self._queues.get(chat_id)
+        while queue:
+            if queue[0].get("playlist"):
+                # Плейлист остаётся в голове очереди, пока не закончится
+                track = await queue[0]["playlist"].pop()
+                if track is None:
+                    queue.pop(0)
+                    continue
+            else:
+                track = queue.pop(0)
+            try:
+                await self._play_track(chat_id, track, owner=(chat_id, "queue"))
+                return True
+            except asyncio.CancelledError:
+                # Очередь очистили, пока трек готовился
+                return False
+            except Exception as e:
+                logger.warning(f"Skipping track {track['title']} in {chat_id}: {e}")
+        
+        if finished:
+            self._now_playing.pop(chat_id, None)
+            self._save_sessions()
+        return False
+
+    async def _on_stream_end(self, _, update):
+        """Конец трека — сразу запускаем следующий"""
+        await self._stream_ended(update.chat_id)
+
+    async def _stream_ended(self, chat_id: int):
+        """Общий обработчик конца трека для своего PyTgCalls и воркеров"""
+        if chat_id in self._active_chats:
+            await self._play_next(chat_id)
+
+    def _detach_station(self, chat_id: int, keep_mixer: bool = False):
+        """Отвязывает чат от станции и его микшера (звонок при этом не покидается)"""
+        for station in self._stations.values():
+            station.chats.discard(chat_id)
+        
+        mixer = None if keep_mixer else self._mixers.pop(chat_id, None)
+        if mixer:
+            task = asyncio.ensure_future(mixer.stop())
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _station_of(self, chat_id: int) -> Optional[Station]:
+        """Микшер или станция, из которых чат получает кадры"""
+        if chat_id in self._mixers:
+            return self._mixers[chat_id]
+        return next((station for station in self._stations.values() if chat_id in station.chats), None)
+
+    async def _attach_external(self, chat_id: int):
+        """Переключает звонок на кадры, которые отправляет модуль"""
+        from pytgcalls.types import ExternalMedia, MediaStream
+        from pytgcalls.types.raw import AudioParameters
+        
+        # Кадры отправляет свой PyTgCalls, поэтому чат уходит с воркера
+        await self._move_chat(chat_id, LOCAL_SHARD)
+        
+        await self._call_py.play(
+            chat_id,
+            MediaStream(
+                ExternalMedia.AUDIO,
+                AudioParameters(bitrate=PCM_SAMPLE_RATE, channels=PCM_CHANNELS),
+            ),
+        )
+        self._active_chats[chat_id] = LOCAL_SHARD
+
+    async def _tune(self, station: Station, chat_id: int):
+        """Подключает чат к станции: звонок получает кадры извне"""
+        self._detach_station(chat_id)
+        self._clear_queue(chat_id)
+        self._now_playing.pop(chat_id, None)
+        
+        await self._attach_external(chat_id)
+        station.chats.add(chat_id)
+        station.set_gain(chat_id, self._volumes.get(chat_id, 1.0))
+
+    async def _mix_play(
+        self,
+        chat_id: int,
+        title: str,
+        source: str,
+        headers: Optional[dict],
+        offset: float = 0,
+        feed: Optional[AsyncIterator[bytes]] = None,
+    ):
+        """Играет трек через личный микшер чата; следующий трек очереди
+        запускается заранее и сводится с текущим"""
+        mixer = self._mixers.get(chat_id)
+        if not mixer:
+            mixer = Station(
+                f"mixer:{chat_id}", lambda: self._call_py, lambda _: self._stream_ended(chat_id)
+            )
+            await self._attach_external(chat_id)
+            mixer.chats.add(chat_id)
+            mixer.set_gain(chat_id, self._volumes.get(chat_id, 1.0))
+            self._mixers[chat_id] = mixer
+        
+        mixer.crossfade = self.config["crossfade"]
+        await mixer.play(
+            source,
+            headers,
+            title,
+            feed,
+            offset=offset,
+            crossfade=mixer.crossfade if mixer.title else 0,
+        )
+
+    async def _set_paused(self, chat_id: int, paused: bool):
+        """Пауза: микшер просто перестаёт отдавать кадры, иначе — через PyTgCalls"""
+        mixer = self._mixers.get(chat_id)
+        if mixer:
+            mixer.paused = paused
+        elif paused:
+            await self._calls(chat_id).pause(chat_id)
+        else:
+            await self._calls(chat_id).resume(chat_id)
+        
+        track = self._now_playing.get(chat_id)
+        if not track:
+            return
+        if paused and not track.get("paused"):
+            track["paused"] = time.time()
+        elif not paused and track.get("paused"):
+            track["started"] += time.time() - track.pop("paused")
 
-    def _check_pytgcalls(self) -> bool:
-        """Проверка доступности pytgcalls"""
-        return self._call_py is not None
+    async def _single_track(self, track: dict) -> Optional[dict]:
+        """Один трек там, где очереди нет: из плейлиста берётся первый"""
+        track = await self._probe_track(track)
+        if track.get("playlist"):
+            return await track["playlist"].pop()
+        return track
+
+    def _progress_editor(self, message: Message) -> ProgressReporter:
+        """Колбэк прогресса для хуков yt-dlp и загрузок из Telegram"""
+        return ProgressReporter(message, self._render_progress, self._stats)
+
+    def _render_progress(self, stage: str, fraction: Optional[float] = None) -> str:
+        if stage in ("downloading", "scanning") and fraction is not None:
+            return self.strings(f"{stage}_progress").format(int(fraction * 100))
+        return self.strings(stage)
 
     def _create_silent_wav(self) -> str:
         """Создаёт временный WAV-файл с тишиной"""
@@ -247,10 +2728,23 @@ class VoiceModMod(loader.Module):
         
         return path
 
+    async def _join_silent(self, chat_id: int):
+        """Заходит в звонок с тишиной"""
+        silent_file = self._create_silent_wav()
+        
+        self._detach_station(chat_id)
+        await self._start_stream(chat_id, silent_file, silent=True)
+        
+        # Удаляем временный файл
+        try:
+            os.remove(silent_file)
+        except:
+            pass
+
     @loader.command(ru_doc="[чат] — подключиться к голосовому чату")
     async def vjoincmd(self, message: Message):
         """Join voice chat"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -258,27 +2752,19 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            from pytgcalls.types import MediaStream
-            
-            silent_file = self._create_silent_wav()
-            
-            await self._call_py.play(chat_id, MediaStream(silent_file))
-            self._active_chats[chat_id] = True
+            await self._join_silent(chat_id)
+            self._save_sessions()
             await utils.answer(message, self.strings("join"))
-            
-            # Удаляем временный файл
-            try:
-                os.remove(silent_file)
-            except:
-                pass
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
     @loader.command(ru_doc="[чат] — отключиться от голосового чата")
     async def vleavecmd(self, message: Message):
         """Leave voice chat"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -286,37 +2772,27 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            await self._call_py.leave_call(chat_id)
+            await self._calls(chat_id).leave_call(chat_id)
             self._active_chats.pop(chat_id, None)
+            self._clear_queue(chat_id)
+            self._now_playing.pop(chat_id, None)
+            self._detach_station(chat_id)
+            self._save_sessions()
             await utils.answer(message, self.strings("leave"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
     @loader.command(ru_doc="[чат] <ссылка/реплай на аудио> — воспроизвести в VC")
     async def vplaycmd(self, message: Message):
         """Play audio in voice chat"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
-        args = utils.get_args_raw(message)
         reply = await message.get_reply_message()
-        
-        link = None
-        audio_file = None
-        
-        # Парсинг аргументов
-        if args:
-            match = re.match(r"(-?\d+|@[\w]{5,})\s+(.*)", args)
-            if match:
-                # Первый аргумент — chat_id, остальное — ссылка
-                link = match.group(2)
-            else:
-                link = args
-        
-        # Проверка реплая на аудио
-        if reply and reply.audio and not link:
-            audio_file = reply
+        link, audio_file = self._parse_play_args(message, reply)
         
         if not link and not audio_file:
             return await utils.answer(message, self.strings("no_audio"))
@@ -326,45 +2802,128 @@ class VoiceModMod(loader.Module):
         if not chat_id:
             return
         
+        # Новая команда в том же чате отменяет подготовку предыдущей
+        owner = (chat_id, "play")
+        self._scheduler.cancel(owner)
+        
+        progress = self._progress_editor(message)
         try:
-            from pytgcalls.types import MediaStream
-            
-            message = await utils.answer(message, self.strings("downloading"))
-            
-            if audio_file:
-                file_path = await audio_file.download_media()
-            else:
-                import yt_dlp
+            with self._stats.timer("vplay"):
+                progress("downloading")
                 
-                ydl_opts = {
-                    "format": "bestaudio/best",
-                    "outtmpl": "%(id)s.%(ext)s",
-                    "quiet": True,
-                    "no_warnings": True,
-                    "postprocessors": [{
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                        "preferredquality": "320",
-                    }],
-                }
+                track = await self._probe_track(self._make_track(link, audio_file))
+                if track.get("playlist"):
+                    # Играем первый трек, остальные разворачиваются по мере игры
+                    playlist = track
+                    track = await playlist["playlist"].pop()
+                    if track is None:
+                        return progress.finish(self.strings("playlist_empty"))
+                    self._queues.setdefault(chat_id, []).insert(0, playlist)
                 
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(link, download=True)
-                    file_path = f"{info['id']}.mp3"
+                await self._prepare_track(track, progress, owner=owner)
+                
+                progress.finish(self.strings("playing"))
+                
+                await self._play_track(chat_id, track, owner=owner)
             
-            message = await utils.answer(message, self.strings("playing"))
+        except asyncio.CancelledError:
+            progress.finish(self.strings("superseded"))
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
+            progress.finish(self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="[чат] <ссылка/реплай на аудио> — добавить в очередь")
+    async def vaddcmd(self, message: Message):
+        """Add track to queue"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        reply = await message.get_reply_message()
+        link, audio_file = self._parse_play_args(message, reply)
+        
+        if not link and not audio_file:
+            return await utils.answer(message, self.strings("no_audio"))
+        
+        chat_id = await self._get_chat_id(message)
+        if not chat_id:
+            return
+        
+        try:
+            track = await self._probe_track(self._make_track(link, audio_file))
+            queue = self._queues.setdefault(chat_id, [])
+            queue.append(track)
             
-            await self._call_py.play(chat_id, MediaStream(file_path))
-            self._active_chats[chat_id] = True
+            if chat_id in self._now_playing:
+                self._prefetch(chat_id)
+                return await utils.answer(message, self.strings("queued").format(len(queue)))
             
+            message = await utils.answer(message, self.strings("downloading"))
+            if await self._play_next(chat_id):
+                await utils.answer(message, self.strings("playing"))
+            else:
+                await utils.answer(message, self.strings("queue_empty"))
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
+            await utils.answer(message, self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="[чат] — следующий трек")
+    async def vskipcmd(self, message: Message):
+        """Skip to next track"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        chat_id = await self._get_chat_id(message)
+        if not chat_id:
+            return
+        
+        try:
+            if await self._play_next(chat_id, finished=False):
+                await utils.answer(message, self.strings("skipped"))
+            else:
+                await utils.answer(message, self.strings("queue_empty"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
+    @loader.command(ru_doc="[чат] — показать очередь")
+    async def vqueuecmd(self, message: Message):
+        """Show queue"""
+        chat_id = await self._get_chat_id(message)
+        if not chat_id:
+            return
+        
+        tracks = []
+        if chat_id in self._now_playing:
+            tracks.append(f"▶️ {utils.escape_html(self._now_playing[chat_id]['title'])}")
+        for i, track in enumerate(self._queues.get(chat_id, []), 1):
+            mark = "📃 " if track.get("playlist") else ""
+            tracks.append(f"{i}. {mark}{utils.escape_html(track['title'])}")
+        
+        if not tracks:
+            return await utils.answer(message, self.strings("queue_empty"))
+        
+        await utils.answer(message, self.strings("queue").format("\n".join(tracks)))
+
+    @loader.command(ru_doc="[чат] — очистить очередь")
+    async def vclearcmd(self, message: Message):
+        """Clear queue"""
+        chat_id = await self._get_chat_id(message)
+        if not chat_id:
+            return
+        
+        self._clear_queue(chat_id)
+        await utils.answer(message, self.strings("cleared"))
+
     @loader.command(ru_doc="[чат] — пауза воспроизведения")
     async def vpausecmd(self, message: Message):
         """Pause playback"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -372,16 +2931,18 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            await self._call_py.pause(chat_id)
+            await self._set_paused(chat_id, True)
             await utils.answer(message, self.strings("pause"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
     @loader.command(ru_doc="[чат] — продолжить воспроизведение")
     async def vresumecmd(self, message: Message):
         """Resume playback"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -389,16 +2950,18 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            await self._call_py.resume(chat_id)
+            await self._set_paused(chat_id, False)
             await utils.answer(message, self.strings("resume"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
     @loader.command(ru_doc="[чат] — остановить воспроизведение")
     async def vstopcmd(self, message: Message):
         """Stop playback"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -406,17 +2969,23 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            await self._call_py.leave_call(chat_id)
+            await self._calls(chat_id).leave_call(chat_id)
             self._active_chats.pop(chat_id, None)
+            self._clear_queue(chat_id)
+            self._now_playing.pop(chat_id, None)
+            self._detach_station(chat_id)
+            self._save_sessions()
             await utils.answer(message, self.strings("stop"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
     @loader.command(ru_doc="[чат] — выключить звук")
     async def vmutecmd(self, message: Message):
         """Mute"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -424,16 +2993,18 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            await self._call_py.mute(chat_id)
+            await self._calls(chat_id).mute(chat_id)
             await utils.answer(message, self.strings("mute"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
     @loader.command(ru_doc="[чат] — включить звук")
     async def vunmutecmd(self, message: Message):
         """Unmute"""
-        if not self._check_pytgcalls():
+        if not await self._ensure_pytgcalls():
             return await utils.answer(message, self.strings("no_pytgcalls"))
         
         chat_id = await self._get_chat_id(message)
@@ -441,12 +3012,276 @@ class VoiceModMod(loader.Module):
             return
         
         try:
-            await self._call_py.unmute(chat_id)
+            await self._calls(chat_id).unmute(chat_id)
             await utils.answer(message, self.strings("unmute"))
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
+            await utils.answer(message, self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="[чат] <0-200> — громкость в чате")
+    async def vvolcmd(self, message: Message):
+        """Set volume"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        args = utils.get_args_raw(message).split()
+        if not args or not args[-1].isdigit() or int(args[-1]) > 200:
+            return await utils.answer(message, self.strings("no_volume"))
+        
+        volume = int(args[-1])
+        chat_id = await self._get_chat_id(message, " ".join(args[:-1]))
+        if not chat_id:
+            return
+        
+        try:
+            self._volumes[chat_id] = volume / 100
+            station = self._station_of(chat_id)
+            if station:
+                # Микшер меняет громкость со следующего кадра
+                station.set_gain(chat_id, volume / 100)
+            else:
+                await self._calls(chat_id).change_volume_call(chat_id, volume)
+            await utils.answer(message, self.strings("volume").format(volume))
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
+            await utils.answer(message, self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="[чат] <ссылка/реплай на аудио> — наложить звук поверх музыки")
+    async def voverlaycmd(self, message: Message):
+        """Mix a sound over the music"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        reply = await message.get_reply_message()
+        link, audio_file = self._parse_play_args(message, reply)
+        
+        if not link and not audio_file:
+            return await utils.answer(message, self.strings("no_audio"))
+        
+        chat_id = await self._get_chat_id(message)
+        if not chat_id:
+            return
+        
+        station = self._station_of(chat_id)
+        if not station:
+            return await utils.answer(message, self.strings("no_mixer"))
+        
+        try:
+            track = await self._single_track(self._make_track(link, audio_file))
+            if track is None:
+                return await utils.answer(message, self.strings("playlist_empty"))
+            
+            source, headers = await self._prepare_track(track)
+            await station.overlay(source, headers)
+            await utils.answer(
+                message, self.strings("overlay").format(utils.escape_html(track["title"]))
+            )
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            await utils.answer(message, self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="<станция> <ссылка/реплай на аудио> — запустить трек на станции")
+    async def vcastcmd(self, message: Message):
+        """Play track on a broadcast station"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        args = utils.get_args_raw(message).split(maxsplit=1)
+        if not args:
+            return await utils.answer(message, self.strings("no_station_name"))
+        
+        name = args[0]
+        link = args[1] if len(args) > 1 else None
+        reply = await message.get_reply_message()
+        audio_file = reply if reply and reply.audio and not link else None
+        
+        if not link and not audio_file:
+            return await utils.answer(message, self.strings("no_audio"))
+        
+        progress = self._progress_editor(message)
+        try:
+            progress("downloading")
+            
+            # Источник готовится один раз, сколько бы чатов ни слушало станцию
+            track = self._make_track(link, audio_file)
+            feed = None
+            
+            if audio_file:
+                # Большой файл начинает играть, как только докачается его начало
+                started = asyncio.get_running_loop().create_future()
+                task = asyncio.ensure_future(
+                    self._download_telegram(audio_file, progress, started.set_result)
+                )
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                await asyncio.wait([task, started], return_when=asyncio.FIRST_COMPLETED)
+                
+                if started.done():
+                    source, headers, feed = None, None, started.result().iter_ready()
+                else:
+                    source, headers = task.result(), None
+            else:
+                # У станции нет очереди — из плейлиста играем первый трек
+                track = await self._single_track(track)
+                if track is None:
+                    return progress.finish(self.strings("playlist_empty"))
+                source, headers = await self._prepare_track(track, progress)
+            
+            station = self._stations.get(name)
+            if not station:
+                station = self._stations[name] = Station(name, lambda: self._call_py)
+            
+            await station.play(
+                source,
+                headers,
+                track["title"],
+                feed,
+                crossfade=self.config["crossfade"] if station.title else 0,
+            )
+            progress.finish(
+                self.strings("station_playing").format(
+                    utils.escape_html(name),
+                    utils.escape_html(track["title"]),
+                    len(station.chats),
+                )
+            )
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            progress.finish(self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="<станция> [чат] — подключить чат к станции")
+    async def vtunecmd(self, message: Message):
+        """Tune a chat to a broadcast station"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        args = utils.get_args_raw(message).split(maxsplit=1)
+        if not args:
+            return await utils.answer(message, self.strings("no_station_name"))
+        
+        station = self._stations.get(args[0])
+        if not station:
+            return await utils.answer(
+                message, self.strings("no_station").format(utils.escape_html(args[0]))
+            )
+        
+        chat_id = await self._get_chat_id(message, args[1] if len(args) > 1 else "")
+        if not chat_id:
+            return
+        
+        try:
+            await self._tune(station, chat_id)
+            await utils.answer(
+                message, self.strings("station_tuned").format(utils.escape_html(station.name))
+            )
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
+            await utils.answer(message, self.strings("error").format(str(e)))
+
+    @loader.command(ru_doc="[чат] — отключить чат от станции")
+    async def vuntunecmd(self, message: Message):
+        """Untune a chat from its station"""
+        if not await self._ensure_pytgcalls():
+            return await utils.answer(message, self.strings("no_pytgcalls"))
+        
+        chat_id = await self._get_chat_id(message)
+        if not chat_id:
+            return
+        
+        try:
+            self._detach_station(chat_id)
+            await self._calls(chat_id).leave_call(chat_id)
+            self._active_chats.pop(chat_id, None)
+            await utils.answer(message, self.strings("station_untuned"))
+        except Exception as e:
+            logger.exception(e)
+            self._stats.record_error(e)
+            self._invalidate_chat_id(chat_id, e)
             await utils.answer(message, self.strings("error").format(str(e)))
 
+    @loader.command(ru_doc="<станция> — остановить станцию и отключить её чаты")
+    async def vcaststopcmd(self, message: Message):
+        """Stop a broadcast station"""
+        name = utils.get_args_raw(message)
+        station = self._stations.pop(name, None)
+        if not station:
+            return await utils.answer(
+                message, self.strings("no_station").format(utils.escape_html(name))
+            )
+        
+        await station.stop()
+        await asyncio.gather(
+            *(self._call_py.leave_call(chat_id) for chat_id in station.chats),
+            return_exceptions=True,
+        )
+        for chat_id in station.chats:
+            self._active_chats.pop(chat_id, None)
+        
+        await utils.answer(message, self.strings("station_stopped").format(utils.escape_html(name)))
+
+    async def _sm_fetch(self, query: str, key: str):
+        """Запрос к @lybot; результат запоминается в кэше"""
+        with self._stats.timer("sm.inline_query"):
+            music = await self._client.inline_query("lybot", query)
+        
+        if not music:
+            return None
+        
+        document = music[0].result.document
+        self._sm_cache[key] = {
+            "id": document.id,
+            "access_hash": document.access_hash,
+            "file_reference": document.file_reference.hex(),
+            "ts": time.time(),
+            "atime": time.time(),
+        }
+        
+        while len(self._sm_cache) > self.config["sm_cache_size"]:
+            oldest = min(self._sm_cache, key=lambda k: self._sm_cache[k]["atime"])
+            self._sm_cache.pop(oldest)
+        
+        self._db.set(__name__, "sm_cache", self._sm_cache)
+        return document
+
+    def _sm_request(self, query: str, key: str) -> asyncio.Future:
+        """Одинаковые запросы, идущие одновременно, делят один поход к боту"""
+        if key not in self._sm_inflight:
+            future = asyncio.ensure_future(self._sm_fetch(query, key))
+            future.add_done_callback(lambda _: self._sm_inflight.pop(key, None))
+            future.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._sm_inflight[key] = future
+        
+        return self._sm_inflight[key]
+
+    async def _sm_search(self, query: str, refresh: bool = False):
+        """Документ для запроса: из кэша или от @lybot"""
+        key = " ".join(query.lower().split())
+        entry = self._sm_cache.get(key)
+        
+        if entry and not refresh and time.time() - entry["ts"] < self.config["sm_cache_ttl"]:
+            self._stats.incr("sm.cache_hit")
+            entry["atime"] = time.time()
+            self._db.set(__name__, "sm_cache", self._sm_cache)
+            
+            if time.time() - entry["ts"] > SM_REFRESH_AGE:
+                # Отдаём закэшированное сразу, file_reference обновится в фоне
+                self._sm_request(query, key)
+            
+            return InputDocument(
+                id=entry["id"],
+                access_hash=entry["access_hash"],
+                file_reference=bytes.fromhex(entry["file_reference"]),
+            )
+        
+        return await asyncio.shield(self._sm_request(query, key))
+
     @loader.command(ru_doc="<название> — найти и отправить музыку")
     async def smcmd(self, message: Message):
         """Search and send music"""
@@ -459,29 +3294,335 @@ class VoiceModMod(loader.Module):
         try:
             message = await utils.answer(message, self.strings("searching"))
             
-            music = await self._client.inline_query("lybot", args)
-            if not music:
+            document = await self._sm_search(args)
+            if not document:
                 return await utils.answer(
                     message, 
                     self.strings("not_found").format(utils.escape_html(args))
                 )
             
             await message.delete()
-            await self._client.send_file(
-                message.peer_id,
-                music[0].result.document,
-                reply_to=reply.id if reply else None,
-            )
+            with self._stats.timer("sm.send_file"):
+                try:
+                    await self._client.send_file(
+                        message.peer_id,
+                        document,
+                        reply_to=reply.id if reply else None,
+                    )
+                except Exception as e:
+                    if type(e).__name__ not in {"FileReferenceExpiredError", "FileReferenceInvalidError"}:
+                        raise
+                    
+                    # Ссылка на файл протухла — берём свежую у бота
+                    document = await self._sm_search(args, refresh=True)
+                    if not document:
+                        raise
+                    await self._client.send_file(
+                        message.peer_id,
+                        document,
+                        reply_to=reply.id if reply else None,
+                    )
         except Exception as e:
             logger.exception(e)
+            self._stats.record_error(e)
             await utils.answer(
                 message,
                 self.strings("not_found").format(utils.escape_html(args))
             )
 
-    @loader.command(ru_doc="<реплай на аудио> — распознать трек через Shazam")
+    async def _decode_pcm(
+        self,
+        data: Optional[bytes],
+        path: Optional[str] = None,
+        start: float = 0,
+    ) -> bytes:
+        """Декодирует SHAZAM_SECONDS секунд (с позиции start) в 16-bit PCM mono"""
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "quiet",
+            "-ss", f"{start:.1f}",
+            "-i", path or "pipe:0",
+            "-t", str(SHAZAM_SECONDS),
+            "-ac", "1", "-ar", str(SHAZAM_SAMPLE_RATE),
+            "-f", "s16le", "pipe:1",
+            stdin=asyncio.subprocess.PIPE if path is None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        pcm, _ = await proc.communicate(data if path is None else None)
+        return pcm
+
+    async def _shazam_sample(
+        self,
+        reply: Message,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+    ) -> bytes:
+        """Короткий WAV-фрагмент для распознавания.
+        Скачивается кусок из середины файла (в начале часто вступление или тишина),
+        а не весь файл целиком"""
+        size = reply.file.size or 0
+        duration = getattr(reply.file, "duration", None)
+        if size and duration:
+            # Байты на нужные секунды + запас на заголовки контейнера
+            budget = int(size / duration * SHAZAM_SECONDS * 1.5) + 256 * 1024
+        else:
+            budget = SHAZAM_FALLBACK_BYTES
+        
+        pcm = b""
+        if size and duration and size > budget * 2:
+            # Смещение кратно размеру запроса — этого требует upload.getFile
+            offset = (size - budget) // 2 // SHAZAM_REQUEST_SIZE * SHAZAM_REQUEST_SIZE
+            pcm = await self._decode_pcm(await self._download_range(reply, offset, budget, progress))
+        
+        if not pcm:
+            # Середина без заголовков контейнера не декодируется (mp4, m4a) — берём начало
+            pcm = await self._decode_pcm(await self._download_range(reply, 0, budget, progress))
+        
+        if not pcm:
+            # Начало файла не декодируется само по себе (например, moov в конце mp4).
+            # Качаем на диск, а не в память, и декодируем отрезок из середины
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                await self._download_file(reply, path, progress)
+                start = max(0, (duration or 0) - SHAZAM_SECONDS) / 2
+                pcm = await self._decode_pcm(None, path, start)
+            finally:
+                os.remove(path)
+        
+        return self._shazam_wav(pcm)
+
+    async def _download_range(
+        self,
+        reply: Message,
+        offset: int,
+        budget: int,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+    ) -> bytes:
+        """Скачивает budget байт файла начиная с offset"""
+        data = bytearray()
+        async for chunk in self._client.iter_download(
+            reply.media, offset=offset, request_size=SHAZAM_REQUEST_SIZE
+        ):
+            data += chunk
+            if progress:
+                progress("downloading", min(len(data) / budget, 1.0))
+            if len(data) >= budget:
+                break
+        self._stats.incr("bytes.downloaded", len(data))
+        return bytes(data)
+
+    @staticmethod
+    def _shazam_wav(pcm: bytes) -> bytes:
+        """Заворачивает PCM в WAV, который принимает shazamio"""
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(SHAZAM_SAMPLE_RATE)
+            wav.writeframes(pcm)
+        
+        return buf.getvalue()
+
+    @staticmethod
+    def _shazam_track(result: dict) -> Optional[dict]:
+        """Название, исполнитель и обложка из ответа Shazam"""
+        track = result.get("track")
+        if not track:
+            return None
+        
+        return {
+            "title": track.get("title", "Unknown"),
+            "artist": track.get("subtitle", "Unknown"),
+            "cover": track.get("images", {}).get("coverart"),
+        }
+
+    def _shazam_remember(self, keys: List[str], result: dict):
+        """Сохраняет результат распознавания под всеми ключами"""
+        for key in keys:
+            self._shazam_cache[key] = dict(result, ts=time.time())
+        
+        while len(self._shazam_cache) > SHAZAM_CACHE_SIZE:
+            oldest = min(self._shazam_cache, key=lambda k: self._shazam_cache[k]["ts"])
+            self._shazam_cache.pop(oldest)
+        
+        self._db.set(__name__, "shazam_cache", self._shazam_cache)
+
+    async def _recognize(
+        self,
+        reply: Message,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+    ) -> Optional[dict]:
+        """Распознаёт трек; результаты кэшируются по id документа и отпечатку звука"""
+        from shazamio import Shazam
+        
+        doc_key = f"doc:{reply.document.id}"
+        if doc_key in self._shazam_cache:
+            return self._shazam_cache[doc_key]
+        
+        with self._stats.timer("shazam.sample"):
+            sample = await self._shazam_sample(reply, progress)
+        fp_key = f"fp:{hashlib.sha1(sample).hexdigest()}"
+        if fp_key in self._shazam_cache:
+            self._shazam_remember([doc_key], self._shazam_cache[fp_key])
+            return self._shazam_cache[fp_key]
+        
+        if progress:
+            progress("recognizing")
+        with self._stats.timer("shazam.recognize"):
+            result = await Shazam().recognize(sample)
+        recognized = self._shazam_track(result)
+        if not recognized:
+            return None
+        
+        self._shazam_remember([doc_key, fp_key], recognized)
+        return recognized
+
+    async def _decode_windows(self, path: str) -> AsyncIterator[Tuple[float, bytes]]:
+        """Потоково декодирует запись и отдаёт перекрывающиеся окна PCM.
+        В памяти держится только текущее окно, а не вся запись"""
+        window = SHAZAM_SECONDS * SHAZAM_SAMPLE_RATE * 2
+        step = SCAN_STEP * SHAZAM_SAMPLE_RATE * 2
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "quiet",
+            "-i", path,
+            "-vn", "-ac", "1", "-ar", str(SHAZAM_SAMPLE_RATE),
+            "-f", "s16le", "pipe:1",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        buf = bytearray()
+        start = 0.0
+        try:
+            while True:
+                chunk = await proc.stdout.read(step)
+                if not chunk:
+                    break
+                buf += chunk
+                while len(buf) >= window:
+                    yield start, bytes(buf[:window])
+                    del buf[:step]
+                    start += SCAN_STEP
+            
+            # Хвост короче окна, но не тот, что уже целиком вошёл в предыдущее
+            tail = len(buf) - (window - step if start else 0)
+            if tail >= SCAN_MIN_TAIL * SHAZAM_SAMPLE_RATE * 2:
+                yield start, bytes(buf)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+
+    async def _scan(
+        self,
+        reply: Message,
+        progress: Optional[Callable[[str, Optional[float]], None]] = None,
+    ) -> List[dict]:
+        """Распознаёт все треки длинной записи (миксы, эфиры).
+        ffmpeg декодирует окна, пока предыдущие уже распознаются;
+        одновременно в Shazam уходит не больше shazam_concurrency запросов"""
+        from shazamio import Shazam
+        
+        scan_key = f"scan:{reply.document.id}"
+        if scan_key in self._shazam_cache:
+            return self._shazam_cache[scan_key]["tracklist"]
+        
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            await self._download_file(reply, path, progress)
+            if progress:
+                progress("scanning", 0.0)
+            
+            shazam = Shazam()
+            duration = getattr(reply.file, "duration", None)
+            workers_count = self.config["shazam_concurrency"]
+            # Ограниченная очередь: декодер ждёт, пока распознавание не догонит
+            windows: asyncio.Queue = asyncio.Queue(maxsize=workers_count * 2)
+            matches: List[Tuple[float, Optional[dict]]] = []
+            processed = 0
+            failed = 0
+            
+            async def worker():
+                nonlocal processed, failed
+                while True:
+                    item = await windows.get()
+                    if item is None:
+                        return
+                    start, pcm = item
+                    try:
+                        with self._stats.timer("shazam.scan_window"):
+                            result = await shazam.recognize(self._shazam_wav(pcm))
+                        matches.append((start, self._shazam_track(result)))
+                    except Exception as e:
+                        # Одно окно не должно ронять весь скан
+                        logger.debug(f"Scan: window at {start:.0f}s failed: {e}")
+                        self._stats.record_error(e)
+                        failed += 1
+                    # Окна завершаются не по порядку — считаем готовые, чтобы процент не скакал
+                    processed += 1
+                    if progress and duration:
+                        progress("scanning", min(processed * SCAN_STEP / duration, 1.0))
+            
+            workers = [asyncio.ensure_future(worker()) for _ in range(workers_count)]
+            try:
+                with self._stats.timer("shazam.scan"):
+                    async for window in self._decode_windows(path):
+                        await windows.put(window)
+                    for _ in workers:
+                        await windows.put(None)
+                    await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+        finally:
+            os.remove(path)
+        
+        tracklist = self._merge_matches(matches)
+        self._stats.incr("shazam.scan_windows", len(matches))
+        self._stats.incr("shazam.scan_failed_windows", failed)
+        if failed:
+            # Скорее всего, ограничение частоты запросов — повторный скан должен попробовать снова
+            logger.warning(f"Scan of document {reply.document.id}: {failed} windows failed, not caching")
+        elif tracklist:
+            self._shazam_remember([scan_key], {"tracklist": tracklist})
+        return tracklist
+
+    @staticmethod
+    def _merge_matches(matches: List[Tuple[float, Optional[dict]]]) -> List[dict]:
+        """Склеивает соседние окна с одним и тем же треком в одну позицию треклиста.
+        Нераспознанные окна (переходы, речь) между ними склейке не мешают"""
+        tracklist: List[dict] = []
+        for start, match in sorted(matches, key=lambda m: m[0]):
+            if not match:
+                continue
+            
+            last = tracklist[-1] if tracklist else None
+            if last and (last["artist"], last["title"]) == (match["artist"], match["title"]):
+                last["end"] = start + SHAZAM_SECONDS
+                last["hits"] += 1
+            else:
+                tracklist.append({
+                    "title": match["title"],
+                    "artist": match["artist"],
+                    "start": start,
+                    "end": start + SHAZAM_SECONDS,
+                    "hits": 1,
+                })
+        
+        return tracklist
+
+    @staticmethod
+    def _timestamp(seconds: float) -> str:
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return f"{hours}:{minutes:02d}:{seconds:02d}"
+        return f"{minutes:02d}:{seconds:02d}"
+
+    @loader.command(ru_doc="[scan] <реплай на аудио> — распознать трек через Shazam (scan — все треки длинной записи)")
     async def shazamcmd(self, message: Message):
-        """Recognize track with Shazam"""
+        """[scan] Recognize track with Shazam (scan — every track of a long recording)"""
         reply = await message.get_reply_message()
         
         if not reply or not reply.file:
@@ -491,59 +3632,122 @@ class VoiceModMod(loader.Module):
         if not mime.startswith("audio") and not mime.startswith("video"):
             return await utils.answer(message, self.strings("reply_audio"))
         
+        progress = self._progress_editor(message)
         try:
-            from shazamio import Shazam
-            
-            message = await utils.answer(message, self.strings("recognizing"))
-            
-            audio_data = await reply.download_media(bytes)
-            
-            shazam = Shazam()
-            result = await shazam.recognize(audio_data)
+            if utils.get_args_raw(message).strip().lower() == "scan":
+                progress("downloading")
+                tracklist = await self._scan(reply, progress)
+                if not tracklist:
+                    return progress.finish(self.strings("not_recognized"))
+                
+                return progress.finish(self.strings("tracklist").format("\n".join(
+                    f"<code>{self._timestamp(item['start'])}</code> "
+                    f"<b>{utils.escape_html(item['artist'])}</b> — {utils.escape_html(item['title'])}"
+                    for item in tracklist
+                )))
             
-            if not result.get("track"):
-                return await utils.answer(message, self.strings("not_recognized"))
+            progress("recognizing")
             
-            track = result["track"]
-            title = track.get("title", "Unknown")
-            artist = track.get("subtitle", "Unknown")
+            track = await self._recognize(reply, progress)
+            if not track:
+                return progress.finish(self.strings("not_recognized"))
             
-            cover_url = None
-            if "images" in track:
-                cover_url = track["images"].get("coverart")
+            title = track["title"]
+            artist = track["artist"]
+            cover_url = track["cover"]
             
             text = self.strings("recognized").format(
                 f"<b>{utils.escape_html(artist)}</b> — {utils.escape_html(title)}"
             )
             
             if cover_url:
+                progress.cancel()
                 await self._client.send_file(
                     message.peer_id,
                     cover_url,
                     caption=text,
                     reply_to=reply.id,
                 )
-                await message.delete()
+                await progress.message.delete()
             else:
-                await utils.answer(message, text)
+                progress.finish(text)
                 
         except ImportError:
-            await utils.answer(
-                message, 
-                self.strings("error").format("shazamio не установлен")
-            )
+            progress.finish(self.strings("error").format("shazamio не установлен"))
         except Exception as e:
             logger.exception(e)
-            await utils.answer(message, self.strings("not_recognized"))
+            self._stats.record_error(e)
+            progress.finish(self.strings("not_recognized"))
+
+    @loader.command(ru_doc="[json] — статистика задержек и счётчики")
+    async def vstatscmd(self, message: Message):
+        """Show latency stats"""
+        snapshot = self._stats.snapshot()
+        snapshot["active_chats"] = len(self._active_chats)
+        if self._shards:
+            snapshot["shards"] = {
+                str(index): sum(1 for shard in self._active_chats.values() if shard == index)
+                for index in range(len(self._shards))
+            }
+        
+        if utils.get_args_raw(message) == "json":
+            return await utils.answer(
+                message, f"<pre>{utils.escape_html(json.dumps(snapshot, indent=1))}</pre>"
+            )
+        
+        timings = "\n".join(
+            f"<code>{utils.escape_html(stage)}</code>: "
+            f"{t['p50'] * 1000:.0f} / {t['p95'] * 1000:.0f} / {t['p99'] * 1000:.0f} ({t['count']})"
+            for stage, t in sorted(snapshot["timings"].items())
+        )
+        counters = "\n".join(
+            f"<code>{utils.escape_html(name)}</code>: {value}"
+            for name, value in sorted(snapshot["counters"].items())
+        )
+        await utils.answer(
+            message,
+            self.strings("stats").format(
+                snapshot["active_chats"],
+                timings or self.strings("stats_empty"),
+                counters or self.strings("stats_empty"),
+            ),
+        )
+
+    @loader.loop(interval=60, autostart=True)
+    async def _stats_logger(self):
+        """Структурированный экспорт статистики в лог"""
+        if self.config["stats_log"]:
+            snapshot = self._stats.snapshot()
+            snapshot["active_chats"] = len(self._active_chats)
+            logger.info(f"voicemod stats: {json.dumps(snapshot)}")
 
     async def on_unload(self):
         """Очистка при выгрузке модуля"""
-        if self._call_py:
+        if self._restore_task:
+            self._restore_task.cancel()
+        
+        # Сохраняем до выхода из звонков — после загрузки модуль вернётся в них
+        self._save_sessions()
+        await self._scheduler.close()
+        
+        for station in (*self._stations.values(), *self._mixers.values()):
+            await station.stop()
+        
+        if self._call_py and self._active_chats:
             try:
-                for chat_id in list(self._active_chats.keys()):
-                    try:
-                        await self._call_py.leave_call(chat_id)
-                    except Exception:
-                        pass
-            except Exception:
-                pass
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        *(self._calls(chat_id).leave_call(chat_id) for chat_id in self._active_chats),
+                        return_exceptions=True,
+                    ),
+                    UNLOAD_LEAVE_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                logger.warning("Timed out leaving voice chats on unload")
+        
+        # Старый PyTgCalls и его обработчики на общем клиенте не должны пережить перезагрузку
+        await self._shutdown_pytgcalls()
+
+        if self._download_pool:
+            self._download_pool.shutdown(wait=False, cancel_futures=True)
+            self._download_pool = None